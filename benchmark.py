@@ -0,0 +1,643 @@
+''' Benchmarks for pybt: micro-benchmarks of the hot paths, and a swarm of
+seeding and leeching Torrents (in separate processes) on loopback.
+
+Usage: python benchmark.py [--json PATH] [swarm options] [name ...]
+'''
+import os
+import time
+import resource
+import logging
+from collections import OrderedDict
+
+import bencode
+
+log = logging.getLogger('benchmark')
+
+MB = 2**20
+
+def measure(func, *args, **kw):
+    ''' Return the best wall-clock time (in seconds) of a few runs. '''
+    repeat = kw.pop('repeat', 3)
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func(*args, **kw)
+        dt = time.time() - start
+        best = dt if best is None else min(best, dt)
+    return best
+
+results = [] # everything reported, for --json
+
+def _format(value):
+    if isinstance(value, float):
+        return '{:.2f}'.format(value) if abs(value) >= 1 else '{:.3g}'.format(value)
+    return value
+
+def report(name, **fields):
+    results.append(OrderedDict([('name', name)] + sorted(fields.items())))
+    fields = ' '.join('{}={}'.format(k, _format(v)) for k, v in sorted(fields.items()))
+    print '{:<24} {}'.format(name, fields)
+
+## bencode
+
+def _legacy_split(s, c):
+    index = s.find(c)
+    assert(c == s[index])
+    return s[:index], s[index+1:]
+
+def _legacy_decode(s):
+    ''' Copying decoder, as used before bencode.decode_prefix(). '''
+    if s[0] == 'i':
+        v, s = _legacy_split(s[1:], 'e')
+        return int(v), s
+
+    if s[0] == 'l':
+        s = s[1:]
+        res = []
+        while s[0] != 'e':
+            obj, s = _legacy_decode(s)
+            res.append(obj)
+        return res, s[1:]
+
+    if s[0] == 'd':
+        s = s[1:]
+        res = OrderedDict()
+        while s[0] != 'e':
+            k, s = _legacy_decode(s)
+            v, s = _legacy_decode(s)
+            res[k] = v
+        return res, s[1:]
+
+    n, s = _legacy_split(s, ':')
+    n = int(n)
+    return s[:n], s[n:]
+
+def synthetic_info(size, piece_length=2**18):
+    ''' Build a bencoded multi-file info dict of roughly `size` bytes.
+        Half of it is the `pieces` string, the rest is the file list.
+    '''
+    hashes = os.urandom(20) * (size // 2 // 20)
+    files = []
+    encoded = 0
+    while encoded < size // 2:
+        f = OrderedDict([('length', piece_length * (len(files) + 1)),
+                         ('path', ['dir{}'.format(len(files) // 100),
+                                   'file{}.bin'.format(len(files))])])
+        encoded += len(bencode.encode(f))
+        files.append(f)
+
+    info = OrderedDict([('files', files), ('name', 'synthetic'),
+                        ('piece length', piece_length), ('pieces', hashes)])
+    return bencode.encode(info)
+
+def bench_bencode(sizes=(1, 10, 50), legacy_max=1):
+    ''' The legacy decoder is quadratic (~15s for 1MB, and 100x that per
+        10x input), so it is only run for sizes up to `legacy_max` MB.
+    '''
+    for size in sizes:
+        data = synthetic_info(size * MB)
+        new = measure(bencode.decode, data)
+        fields = dict(size_mb=size, new_s=new)
+
+        if size <= legacy_max:
+            assert bencode.decode(data) == _legacy_decode(data)[0]
+            old = measure(_legacy_decode, data, repeat=1)
+            fields.update(legacy_s=old, speedup=old / new)
+
+        report('bencode.decode', **fields)
+
+## peer wire protocol
+
+_sample_commands = OrderedDict([
+    ('keep_alive', {}),
+    ('choke', {}),
+    ('have', dict(index=123)),
+    ('bitfield', dict(bits='\xff' * 1024)),
+    ('request', dict(index=123, begin=2**14, length=2**14)),
+    ('piece', dict(index=123, begin=2**14, data='\x00' * 2**14)),
+    ('cancel', dict(index=123, begin=2**14, length=2**14)),
+    ('extended', dict(cmd=3, msg='d8:msg_typei0e5:piecei0ee')),
+])
+
+def bench_peer(count=100000, target=100000):
+    ''' Build and parse rates per message type; the target is for `piece` parsing. '''
+    import peer
+    for name, kw in _sample_commands.items():
+        msg = peer.build_command(name, **kw)
+        build = measure(lambda: [peer.build_command(name, **kw) for _ in xrange(count)])
+        parse = measure(lambda: [peer.parse_command(msg) for _ in xrange(count)])
+        fields = dict(build_per_s=int(count / build), parse_per_s=int(count / parse))
+        if name == 'piece':
+            fields['target_met'] = (count / parse >= target)
+        report('peer.' + name, **fields)
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def bench_stream(count=20480):
+    ''' Receive piece messages from a local sender over loopback.
+        `count` should be a multiple of 64 (the send batch size).
+    '''
+    import gevent.server
+    import connection
+    import peer
+
+    msg = peer.build_command('piece', index=0, begin=0, data='\x00' * 2**14)
+    def sender(sock, addr):
+        batch = msg * 64
+        for _ in xrange(count // 64):
+            sock.sendall(batch)
+        sock.close()
+
+    server = gevent.server.StreamServer(('127.0.0.1', 0), sender)
+    server.start()
+    try:
+        conn = peer.Connection(connection.Stream(server.address))
+        start, cpu = time.time(), cpu_time()
+        for _ in xrange(count):
+            conn.recv_cmd()
+        dt, cpu = time.time() - start, cpu_time() - cpu
+    finally:
+        server.stop()
+
+    size = count * len(msg) / float(MB)
+    report('connection.recv', pieces=count, mb_per_s=size / dt, cpu_s_per_mb=cpu / size,
+        recv_calls_per_piece=conn.conn.recv_calls / float(count))
+
+def _pipeline_run(depth, latency, rate, duration, block=2**14):
+    import gevent
+    import gevent.queue
+    import gevent.server
+    import connection
+    import download
+    import peer
+
+    data = '\x00' * block
+    request_size = len(peer.build_command('request', index=0, begin=0, length=0))
+
+    def seeder(sock, addr):
+        ready = gevent.queue.Queue()
+        def reader():
+            f = sock.makefile('rb')
+            while True:
+                msg = f.read(request_size)
+                if len(msg) < request_size:
+                    return
+                req = peer.parse_command(msg)
+                gevent.spawn_later(latency, ready.put, (req.index, req.begin))
+
+        g = gevent.spawn(reader)
+        try:
+            while True:
+                index, begin = ready.get()
+                sock.sendall(peer.build_command('piece', index=index, begin=begin, data=data))
+                gevent.sleep(block / float(rate))
+        except EnvironmentError:
+            pass
+        finally:
+            g.kill()
+
+    server = gevent.server.StreamServer(('127.0.0.1', 0), seeder)
+    server.start()
+    try:
+        conn = peer.Connection(connection.Stream(server.address))
+        if depth is None:
+            pipeline = download.Pipeline(block, min_depth=1, max_depth=2**8)
+        else:
+            pipeline = download.Pipeline(block, min_depth=depth, max_depth=depth, depth=depth)
+
+        pending = set()
+        index = received = 0
+        start = time.time()
+        while time.time() - start < duration:
+            while len(pending) < pipeline.depth:
+                req = download.Request(index, 0, block)
+                index = index + 1
+                conn.send_cmd('request', **vars(req))
+                pending.add(req)
+                pipeline.sent(req)
+
+            event = conn.recv_cmd()
+            req = download.Request(event.index, event.begin, len(event.data))
+            pending.remove(req)
+            pipeline.received(req, req.length)
+            received = received + req.length
+
+        dt = time.time() - start
+        conn.close()
+    finally:
+        server.stop()
+
+    return received / dt / MB, pipeline.depth
+
+def bench_pipeline(latency=0.05, rate=8*MB, duration=5.0, depths=(1, 2, 4, 8, 16, 32, 64)):
+    ''' Download from a loopback seeder which answers each request after
+        `latency` seconds and sends at most `rate` bytes/second.
+        Fixed depths should scale until depth * block / latency reaches `rate`,
+        and the adaptive depth should get close to `rate`.
+    '''
+    for depth in list(depths) + [None]:
+        mb_per_s, final_depth = _pipeline_run(depth, latency, rate, duration)
+        report('download.Pipeline', depth=depth or 'adaptive', final_depth=final_depth,
+            mb_per_s=mb_per_s, limit_mb_per_s=rate / float(MB))
+
+def _in_child(func, *args):
+    ''' Run func(*args) in a fresh process, so that its peak RSS can be measured. '''
+    import multiprocessing
+    q = multiprocessing.Queue()
+    p = multiprocessing.Process(target=lambda: q.put(func(*args)))
+    p.start()
+    result = q.get()
+    p.join()
+    return result
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # kB on Linux
+
+def _legacy_block_state(n, piece_length, block_size):
+    ''' Per-block Request objects, as Torrent kept them before the picker. '''
+    import download
+    return OrderedDict((download.Request(i, offset, block_size), set())
+        for i in xrange(n) for offset in xrange(0, piece_length, block_size))
+
+def _block_state(n, piece_length, block_size):
+    import picker
+    import storage
+    bits = storage.bitfield(None, n)
+    return picker.Picker(n, lambda i: piece_length // block_size,
+                         wanted=storage.indices(~bits))
+
+def _block_state_memory(create, size, piece_length, block_size):
+    before = peak_rss()
+    start = time.time()
+    state = create(size // piece_length, piece_length, block_size)
+    return peak_rss() - before, time.time() - start
+
+def bench_blocks(sizes_gb=(1, 10, 50, 200), piece_length=2**18, block_size=2**14, legacy_max=10):
+    ''' Memory used by Torrent's block state, for torrents of various sizes.
+        storage.Data is not included, since it hashes the whole file.
+    '''
+    for size in sizes_gb:
+        creators = [('picker', _block_state)]
+        if size <= legacy_max:
+            creators.append(('legacy', _legacy_block_state))
+        for name, create in creators:
+            rss, dt = _in_child(_block_state_memory, create, size * 2**30, piece_length, block_size)
+            report('download.Torrent', state=name, size_gb=size,
+                peak_rss_mb=rss / float(MB), init_s=dt)
+
+def synthetic_torrent(size, piece_length=2**18, name='synthetic'):
+    ''' Write a file of random pieces named like storage.Data expects it
+        (in the current directory), and return its MetaInfo.
+    '''
+    import binascii
+    import metainfo
+    data = os.urandom(min(size, 2**24))
+    hashes = []
+    info = OrderedDict([('length', size), ('name', name), ('piece length', piece_length)])
+    with open(name + '.part', 'wb') as f:
+        for offset in xrange(0, size, piece_length):
+            piece = data[offset % len(data):][:min(piece_length, size - offset)]
+            f.write(piece)
+            hashes.append(metainfo.hash(piece))
+    info['pieces'] = ''.join(hashes)
+    meta = metainfo.MetaInfo(info)
+    os.rename(name + '.part', binascii.hexlify(meta.info_hash) + '.tmp')
+    return meta
+
+def bench_validate(size=2**28, piece_length=2**18, workers=None):
+    ''' Startup validation of a complete file, by number of hashing threads. '''
+    import multiprocessing
+    import shutil
+    import tempfile
+    import storage
+
+    if workers is None:
+        cpus = multiprocessing.cpu_count()
+        workers = sorted(set([n for n in (1, 2, 4) if n < cpus] + [cpus]))
+
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        meta = synthetic_torrent(size, piece_length)
+        for n in workers:
+            start, cpu = time.time(), cpu_time()
+            data = storage.Data(meta, workers=n)
+            dt, cpu = time.time() - start, cpu_time() - cpu
+            assert all(data.bits)
+            data.fd.close()
+            data.io.kill()
+            os.remove(data.resume_fname) # so that the next run validates again
+            report('storage.Data.validate', workers=n, size_mb=size // MB,
+                mb_per_s=size / dt / MB, cpu_s=cpu)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+class _Peer:
+    ''' Stands in for a peer.Connection, for scheduling without sockets. '''
+    class _Stream:
+        def download_rate(self):
+            return None
+
+    def __init__(self, name):
+        self.name = name
+        self.state = {}
+        self.conn = self._Stream()
+
+    def send_cmd(self, name, **kw):
+        pass
+
+def bench_request(size=2**28, piece_length=2**18, peers=8, depth=64):
+    ''' Request scheduling (Torrent._request) of all the blocks of a torrent
+        missing its data, for unchoked peers having random halves of its pieces.
+        Each round, every peer gets `depth` new requests, as if the previous
+        ones were answered.
+    '''
+    import random
+    import shutil
+    import tempfile
+    import bitarray
+    import download
+
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        meta = synthetic_torrent(size, piece_length)
+        os.remove(os.listdir('.')[0]) # nothing was downloaded yet
+        t = download.Torrent('b' * 20, meta, listen=False)
+        n = len(meta.hashes)
+        conns = []
+        for k in xrange(peers):
+            conn = _Peer('peer{}'.format(k))
+            bits = bitarray.bitarray([random.random() < 0.5 for _ in xrange(n)], endian='big')
+            conn.state.update(am_choking=False, peer_bits=bits)
+            conn._pending_requests = set()
+            conn._pipeline = download.Pipeline(t.block_size, depth, depth, depth=depth)
+            t.picker.add(bits)
+            conns.append(conn)
+
+        count = 0
+        start = time.time()
+        while True:
+            sent = 0
+            for conn in conns:
+                t._request(conn)
+                sent += len(conn._pending_requests)
+                for req in conn._pending_requests:
+                    conn._pipeline.discard(req)
+                conn._pending_requests.clear()
+            t.requests.clear()
+            if not sent:
+                break
+            count += sent
+        dt = time.time() - start
+        t.data.close()
+
+        report('download.Torrent._request', peers=peers, depth=depth, blocks=count,
+            requests_per_s=int(count / dt))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+def bench_cache(size=2**26, piece_length=2**18, block_size=2**14, peers=8, requests=20000):
+    ''' Serve block requests of several peers, each downloading pieces in
+        random order block by block, with and without the read cache.
+    '''
+    import random
+    import shutil
+    import tempfile
+    import storage
+
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        meta = synthetic_torrent(size, piece_length)
+        data = storage.Data(meta)
+        n = len(meta.hashes)
+        blocks = piece_length // block_size
+        # interleave the requests of peers, each one requesting whole pieces
+        streams = [((i, b * block_size) for i in random.sample(xrange(n), n)
+                    for b in xrange(blocks)) for _ in xrange(peers)]
+        reqs = [next(streams[k % peers]) for k in xrange(requests)]
+
+        cache = storage.ReadCache(data, max_size=2**24)
+        for name, read in [('uncached', data.read), ('cached', cache.read)]:
+            dt = measure(lambda: [read(i, begin, block_size) for i, begin in reqs], repeat=1)
+            report('storage.ReadCache', mode=name, requests_per_s=int(requests / dt),
+                mb_per_s=requests * block_size / dt / MB)
+        report('storage.ReadCache', hits=cache.hits, misses=cache.misses, evictions=cache.evictions)
+        data.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+def bench_storage(size=2**28, piece_length=2**18, block_size=2**14):
+    ''' Block write and read throughput of the storage backends. '''
+    import shutil
+    import tempfile
+    import storage
+
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        meta = synthetic_torrent(size, piece_length)
+        content = open(os.listdir('.')[0], 'rb').read()
+        os.remove(os.listdir('.')[0])
+        blocks = [(i, begin) for i in xrange(len(meta.hashes))
+                  for begin in xrange(0, piece_length, block_size)]
+
+        for name, backend in sorted(storage.backends.items()):
+            data = backend(meta)
+            start = time.time()
+            for i, begin in blocks:
+                offset = i * piece_length + begin
+                data.write(i, begin, buffer(content, offset, block_size))
+            data.flush()
+            write = time.time() - start
+
+            start = time.time()
+            for i, begin in blocks:
+                data.read(i, begin, block_size)
+            read = time.time() - start
+            data.close()
+            for fname in os.listdir('.'): # the files backend creates a directory
+                if os.path.isdir(fname):
+                    shutil.rmtree(fname)
+                else:
+                    os.remove(fname)
+
+            report('storage.' + backend.__name__, backend=name,
+                write_mb_per_s=size / write / MB, read_mb_per_s=size / read / MB)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+## loopback swarm
+
+def _swarm_tracker(urls):
+    import gevent
+    import tracker
+    server = tracker.Server(interval=1)
+    server.start()
+    urls.put(server.url)
+    gevent.wait()
+
+def _swarm_peer(meta, path, host_id, url, start, stop, results):
+    ''' Run a Torrent in `path` from the `start` event until the `stop` event.
+        A leecher reports when it completes, and a seeder when it stops.
+    '''
+    import gevent
+    import download
+
+    os.chdir(path)
+    t = download.Torrent(host_id, meta, port=0, listen=False, min_interval=1)
+    t.listen()
+    role = 'seeder' if t.done() else 'leecher'
+    if role == 'seeder':
+        list(t.get_peers([url])) # be known to the tracker before the leechers start
+    results.put(None) # ready
+    start.wait()
+
+    begin, cpu = time.time(), cpu_time()
+    def stats(**fields):
+        return dict(role=role, cpu_s=cpu_time() - cpu, peak_rss=peak_rss(), **fields)
+
+    def run():
+        if role == 'leecher':
+            t.run([url])
+            results.put(stats(time_s=time.time() - begin, done=t.done()))
+        t.run([url]) # seed to the other leechers
+
+    g = gevent.spawn(run)
+    while not stop.is_set():
+        gevent.sleep(0.05)
+    g.kill()
+    if role == 'seeder':
+        results.put(stats())
+    t.data.close()
+
+def bench_swarm(size=2**26, piece_length=2**18, seeders=1, leechers=2, timeout=600):
+    ''' Download a synthetic torrent by `leechers` Torrents from `seeders`
+        Torrents, each in its own process and directory, which find each other
+        through a local UDP tracker. Reports the time until the last leecher
+        completed, the aggregate download rate, the CPU time of all the
+        processes per GB downloaded, and the largest peak RSS among them.
+    '''
+    import multiprocessing
+    import shutil
+    import tempfile
+
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    procs = []
+    try:
+        os.chdir(tmp)
+        meta = synthetic_torrent(size, piece_length)
+        fname = os.listdir('.')[0]
+        paths = []
+        for k in xrange(seeders + leechers):
+            path = os.path.join(tmp, 'peer{}'.format(k))
+            os.mkdir(path)
+            if k < seeders:
+                shutil.copy(fname, path)
+            paths.append(path)
+        os.remove(fname)
+
+        urls = multiprocessing.Queue()
+        procs.append(multiprocessing.Process(target=_swarm_tracker, args=(urls,)))
+        procs[-1].start()
+        url = urls.get()
+
+        start, stop = multiprocessing.Event(), multiprocessing.Event()
+        results = multiprocessing.Queue()
+        for k, path in enumerate(paths):
+            host_id = '{:020d}'.format(k)
+            procs.append(multiprocessing.Process(target=_swarm_peer,
+                args=(meta, path, host_id, url, start, stop, results)))
+            procs[-1].start()
+            results.get() # so the seeders are announced first
+        start.set()
+
+        peers = [results.get(timeout=timeout) for _ in xrange(leechers)]
+        stop.set()
+        peers += [results.get(timeout=timeout) for _ in xrange(seeders)]
+    finally:
+        for p in procs:
+            p.terminate()
+            p.join()
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+    elapsed = max(p['time_s'] for p in peers if p['role'] == 'leecher')
+    downloaded = leechers * size
+    report('swarm', seeders=seeders, leechers=leechers, size_mb=size / float(MB),
+        piece_kb=piece_length // 1024, time_s=elapsed,
+        done=all(p['done'] for p in peers if p['role'] == 'leecher'),
+        mb_per_s=downloaded / elapsed / MB,
+        cpu_s_per_gb=sum(p['cpu_s'] for p in peers) / (downloaded / float(2**30)),
+        peak_rss_mb=max(p['peak_rss'] for p in peers) / float(MB))
+
+benchmarks = OrderedDict([
+    ('bencode', bench_bencode),
+    ('peer', bench_peer),
+    ('stream', bench_stream),
+    ('pipeline', bench_pipeline),
+    ('blocks', bench_blocks),
+    ('request', bench_request),
+    ('validate', bench_validate),
+    ('cache', bench_cache),
+    ('storage', bench_storage),
+    ('swarm', bench_swarm),
+])
+
+def _commit():
+    import subprocess
+    try:
+        with open(os.devnull, 'w') as null:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=null,
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(names, options=None, json_path=None):
+    ''' Run the named benchmarks (all by default), passing `options[name]`
+        as keyword arguments. With `json_path`, the results are saved there
+        along with the current commit, for comparing them across commits.
+    '''
+    options = options or {}
+    for name in (names or benchmarks.keys()):
+        benchmarks[name](**options.get(name, {}))
+
+    if json_path:
+        import json
+        import platform
+        obj = OrderedDict([('commit', _commit()), ('python', platform.python_version()),
+                           ('time', time.time()), ('results', results)])
+        with open(json_path, 'w') as f:
+            json.dump(obj, f, indent=2)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='pybt benchmarks')
+    parser.add_argument('names', nargs='*', help=', '.join(benchmarks))
+    parser.add_argument('--json', metavar='PATH', help='save the results as JSON')
+    parser.add_argument('--size', type=int, default=64, help='swarm torrent size (MB)')
+    parser.add_argument('--piece-length', type=int, default=256, help='swarm piece length (kB)')
+    parser.add_argument('--seeders', type=int, default=1)
+    parser.add_argument('--leechers', type=int, default=2)
+    args = parser.parse_args()
+    unknown = set(args.names) - set(benchmarks)
+    if unknown:
+        parser.error('unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+    logging.basicConfig(
+        format='%(asctime)-15s [%(levelname)s] %(name)s: %(message)s',
+        level=logging.INFO)
+    swarm = dict(size=args.size * MB, piece_length=args.piece_length * 1024,
+                 seeders=args.seeders, leechers=args.leechers)
+    main(args.names, options=dict(swarm=swarm), json_path=args.json)
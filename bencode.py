@@ -15,43 +15,91 @@ def encode(obj):
 	enc = _encoders[T]
 	return enc(obj)
 
-def split(s, c):
-	index = s.find(c)
-	assert(c == s[index])
-	return s[:index], s[index+1:]
-
-def decode(s):
-	obj, rest = _decode(s)
-	assert rest == ''
+def decode(s, spans=None):
+	obj, offset = decode_prefix(s, spans=spans)
+	if offset != len(s):
+		raise Error('{} trailing bytes after offset {}'.format(len(s) - offset, offset))
 	return obj
 
-def _decode(s):
-	if s[0] == 'i': # i<integer>s
-		v, s = split(s[1:], 'e')
-		res = int(v)
-		return res, s
-
-	if s[0] == 'l': # l<item1>...<itemN>e
-		s = s[1:]
-		res = []
-		while s[0] != 'e':
-			obj, s = _decode(s)
-			res.append(obj)
-		return res, s[1:]
-
-	if s[0] == 'd': # d<key1><value1>...<keyN><valueN>e
-		s = s[1:]
-		res = OrderedDict()
-		while s[0] != 'e':
-			k, s = _decode(s)
-			v, s = _decode(s)
-			res[k] = v
-		return res, s[1:]
-
-	# length-prefixed string (L:s1s2s3...sL)
-	n, s = split(s, ':')
-	n = int(n) 
-	return s[:n], s[n:]
+def decode_prefix(s, offset=0, spans=None):
+	''' Decode a single object starting at `offset`.
+	    Return the object and the offset just past its end,
+	    so that any trailing (non-bencoded) data can be sliced out of `s`.
+
+	    If `spans` is a dict, the raw (begin, end) offsets of the values of the
+	    top-level dictionary whose key is in `spans` are stored into it, e.g.
+	    `spans={'info': None}` allows hashing s[begin:end] without re-encoding
+	    the info dict. Keys of nested dictionaries are not matched.
+	'''
+	return _decode(s, offset, spans)
+
+# All decoders take the whole input buffer and an offset into it,
+# and return the decoded object and the offset following it.
+# `spans` records raw value offsets of the top-level dict only (see decode_prefix),
+# so it is not passed on to nested values.
+# Only the decoded tokens themselves are copied out of the buffer.
+
+def _find(s, c, offset):
+	index = s.find(c, offset)
+	if index < 0:
+		raise Error('missing {!r} after offset {}'.format(c, offset))
+	return index
+
+def _decode_int(s, offset, spans): # i<integer>e
+	end = _find(s, 'e', offset + 1)
+	try:
+		res = int(s[offset+1:end])
+	except ValueError:
+		raise Error('invalid integer at offset {}'.format(offset))
+	return res, end + 1
+
+def _decode_list(s, offset, spans): # l<item1>...<itemN>e
+	offset = offset + 1
+	res = []
+	while s[offset:offset+1] != 'e':
+		obj, offset = _decode(s, offset)
+		res.append(obj)
+	return res, offset + 1
+
+def _decode_dict(s, offset, spans): # d<key1><value1>...<keyN><valueN>e
+	offset = offset + 1
+	res = OrderedDict()
+	while s[offset:offset+1] != 'e':
+		if s[offset:offset+1] and not s[offset].isdigit():
+			raise Error('dictionary key at offset {} is not a string'.format(offset))
+		k, offset = _decode(s, offset)
+		begin = offset
+		v, offset = _decode(s, offset)
+		res[k] = v
+		if spans is not None and k in spans and spans[k] is None:
+			spans[k] = (begin, offset)
+	return res, offset + 1
+
+def _decode_str(s, offset, spans): # length-prefixed string (L:s1s2s3...sL)
+	colon = _find(s, ':', offset)
+	try:
+		n = int(s[offset:colon])
+	except ValueError:
+		raise Error('invalid string length at offset {}'.format(offset))
+	start = colon + 1
+	end = start + n
+	if n < 0 or end > len(s):
+		raise Error('string of {} bytes at offset {} exceeds input'.format(n, offset))
+	return s[start:end], end
+
+_decoders = {'i': _decode_int, 'l': _decode_list, 'd': _decode_dict}
+_decoders.update((str(d), _decode_str) for d in range(10))
+
+def _decode(s, offset, spans=None):
+	c = s[offset:offset+1]
+	if not c:
+		raise Error('unexpected end of data at offset {}'.format(offset))
+
+	dec = _decoders.get(c)
+	if dec is None:
+		raise Error('invalid token {!r} at offset {}'.format(c, offset))
+
+	return dec(s, offset, spans)
 
 ## Unittests
 if __name__ == '__main__':
@@ -60,10 +108,34 @@ if __name__ == '__main__':
 		(-45, 'i-45e'), 
 		('spam', '4:spam'), 
 		('firefox', '7:firefox'),
-		(OrderedDict([(1, 2), (3, 4)]), 'di1ei2ei3ei4ee'),
+		(OrderedDict([('a', 2), ('b', 4)]), 'd1:ai2e1:bi4ee'),
 		(['spam', 'eggs', 67], 'l4:spam4:eggsi67ee'),
 	]
 	for x, y in tests:
 		print '{} <=> {}'.format(x, y)
 		assert encode(x) == y
 		assert decode(y) == x
+
+	obj, offset = decode_prefix('d8:msg_typei1ee<raw piece data>')
+	assert obj == OrderedDict(msg_type=1)
+	assert offset == 15
+
+	s = 'd8:announce3:url4:infod4:name4:spamee'
+	spans = {'info': None, 'name': None, 'missing': None}
+	obj = decode(s, spans=spans)
+	assert s[slice(*spans['info'])] == encode(obj['info'])
+	assert spans['name'] is None # not a top-level key
+	assert spans['missing'] is None
+
+	s = 'd4:infod4:infoi1e4:name1:xee'
+	spans = {'info': None}
+	decode(s, spans=spans)
+	assert s[slice(*spans['info'])] == 'd4:infoi1e4:name1:xe'
+
+	for s in ['', 'i12', 'ixe', 'l4:spam', '5:spam', 'x', 'i1ei2e', 'd1:a', 'di1ei2ee', 'dli1eei1ee', 'd']:
+		try:
+			decode(s)
+		except Error as e:
+			print '{!r}: {}'.format(s, e)
+		else:
+			assert False, s
@@ -1,6 +1,9 @@
+import time
 import logging
 import functools
 
+import gevent
+import gevent.lock
 from gevent import socket
 
 log = logging.getLogger('connection')
@@ -8,50 +11,196 @@ log = logging.getLogger('connection')
 class Closed(Exception):
     pass
 
+class Bucket:
+    ''' Token bucket, allowing `rate` bytes/second on average (None for no limit)
+        and bursts of up to `burst` bytes.
+
+    Each take() reserves its tokens as soon as it is called (the balance may go
+    negative), and then sleeps until the reservation is covered. So greenlets
+    are granted in the order they asked, and a large take() is split into
+    `burst`-sized reservations, letting other greenlets interleave with it.
+    '''
+    def __init__(self, rate=None, burst=None, clock=time.time, sleep=gevent.sleep):
+        self.rate = rate
+        self.burst = burst or (max(int(rate), 2**14) if rate else None) # at least a block
+        self.tokens = self.burst
+        self.clock = clock
+        self.sleep = sleep
+        self.stamp = clock()
+        self.users = 0 # streams sharing this bucket
+
+    def take(self, n):
+        if self.rate is None:
+            return
+        while n > 0:
+            chunk = min(n, self.burst)
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= chunk
+            if self.tokens < 0:
+                self.sleep(-self.tokens / float(self.rate))
+            n -= chunk
+
+    def share(self):
+        ''' Return the rate available to each of its streams (None if unlimited). '''
+        if self.rate is not None:
+            return self.rate / float(max(self.users, 1))
+
+class Limit:
+    ''' Upload and download rate limits (bytes/second, None for unlimited),
+        which may be shared by many streams (e.g. of a torrent, or globally).
+    '''
+    def __init__(self, upload=None, download=None):
+        self.upload = Bucket(upload)
+        self.download = Bucket(download)
+
 class Stream:
-    def __init__(self, addr, timeout=None):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        if timeout is not None:
+    chunk_size = 2**18 # bytes to ask for on each socket read
+
+    def __init__(self, addr, timeout=None, sock=None, limits=()):
+        ''' Connect to `addr`, unless an accepted `sock` is given.
+            Sending and receiving are throttled by all the given `limits`.
+        '''
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            log.info('connecting to peer at {}'.format(addr))
+            if timeout is not None:
+                sock.settimeout(timeout)
+            try:
+                sock.connect(addr)        
+            except (socket.timeout, socket.error) as e:
+                raise Closed(e)
+        elif timeout is not None:
             sock.settimeout(timeout)
-        log.info('connecting to peer at {}'.format(addr))
-        try:
-            sock.connect(addr)        
-        except (socket.timeout, socket.error) as e:
-            raise Closed(e)
         self.sock = sock
+        self.send_lock = gevent.lock.Semaphore() # other greenlets may send too (e.g. cancel)
+        self.upload = []
+        self.download = []
+        self.limit(limits)
+
+        self.rbuf = '' # received data
+        self.roff = 0  # offset of the first unconsumed byte in rbuf
+        self.recv_calls = 0
 
-    def recv(self, n):        
+    def _fill(self, n):
+        ''' Make sure at least `n` unconsumed bytes are buffered,
+            reading as much as is available (up to chunk_size) per syscall.
+        '''
+        left = len(self.rbuf) - self.roff
+        if left >= n:
+            return
+
+        chunks = [self.rbuf[self.roff:]] if left else []
         try:
-            data = _recvall(self.sock, n)
+            while left < n:
+                buf = self.sock.recv(max(self.chunk_size, n - left))
+                self.recv_calls += 1
+                if not buf: # peer socket is closed
+                    raise Closed('peer closed connection')
+                chunks.append(buf)
+                for bucket in self.download:
+                    bucket.take(len(buf))
+                left = left + len(buf)
         except (socket.timeout, socket.error) as e:
             raise Closed(e)
 
-        if data is None: # peer socket is closed
-            raise Closed('peer closed connection')
+        self.rbuf = ''.join(chunks)
+        self.roff = 0
+
+    def peek(self, n):
+        ''' Return the next `n` bytes, without consuming them. '''
+        self._fill(n)
+        return self.rbuf[self.roff:self.roff + n]
 
-        return data 
+    def recv(self, n, view=False):
+        ''' Return the next `n` bytes.
+            With `view`, a zero-copy buffer into the receive buffer is returned.
+        '''
+        self._fill(n)
+        start = self.roff
+        self.roff = start + n
+        if view:
+            return buffer(self.rbuf, start, n)
+        return self.rbuf[start:self.roff]
 
     def send(self, data):
         try:
-            _sendall(self.sock, data)
+            with self.send_lock: # don't interleave partially sent messages
+                for bucket in self.upload:
+                    bucket.take(len(data))
+                _sendall(self.sock, data)
         except (socket.timeout, socket.error) as e:
             raise Closed(e)
 
+    def limit(self, limits):
+        ''' Throttle sending and receiving by all the given `limits` too. '''
+        upload = [l.upload for l in limits if l.upload.rate is not None]
+        download = [l.download for l in limits if l.download.rate is not None]
+        for bucket in upload + download:
+            bucket.users += 1
+        self.upload = self.upload + upload
+        self.download = self.download + download
+
+    def download_rate(self):
+        ''' Return the download rate this stream may get (None if unlimited). '''
+        rates = [bucket.share() for bucket in self.download]
+        return min(rates) if rates else None
+
     def close(self):
+        for bucket in self.upload + self.download:
+            bucket.users -= 1
+        self.upload = self.download = []
         self.sock.close()
 
-def _recvall(sock, n):
-        data = ''
-        while True:
-            left = n - len(data)
-            if left == 0:
-                return data
+def _sendall(sock, data):
+    sock.sendall(data)
+
+## Unittests
 
-            buf = sock.recv(left)
-            if not buf: # peer socket is closed
-                return None
+def test():
+    # deterministic, with a simulated clock
+    now = [0.0]
+    def sleep(dt):
+        now[0] += dt
+    b = Bucket(rate=1000, burst=100, clock=lambda: now[0], sleep=sleep)
+    b.take(100) # a burst is allowed immediately
+    assert now[0] == 0
+    b.take(1000)
+    assert abs(now[0] - 1.0) < 1e-9
+    now[0] += 10 # idle time is credited only up to a burst
+    b.take(300)
+    assert abs(now[0] - 11.2) < 1e-9
+    Bucket().take(2**30) # unlimited
 
-            data = data + buf
+    # greenlets are served in turns, so they finish together
+    b = Bucket(rate=2**20, burst=2**14)
+    b.take(2**14)
+    finished = {}
+    def take(name):
+        b.take(2**18)
+        finished[name] = time.time()
+    start = time.time()
+    gevent.joinall([gevent.spawn(take, name) for name in 'ab'])
+    assert abs(finished['a'] - finished['b']) < 0.1
+    assert 0.4 < time.time() - start < 0.6
 
-def _sendall(sock, data):
-    sock.sendall(data)
+    # loopback streams, limited globally and per stream
+    shared = Limit(upload=2**20, download=2**18)
+    a, b = socket.socketpair()
+    sender = Stream(None, sock=a, limits=[shared, Limit(upload=2**21)])
+    receiver = Stream(None, sock=b, limits=[shared])
+    assert shared.download.users == 2 and receiver.download_rate() == 2**17
+    data = 'x' * 2**19 # half of it within the initial burst
+    start = time.time()
+    g = gevent.spawn(sender.send, data)
+    assert receiver.recv(len(data)) == data
+    g.join()
+    elapsed = time.time() - start # the download limit is the tightest
+    assert 0.9 < elapsed < 1.2, elapsed
+    sender.close()
+    receiver.close()
+    assert shared.download.users == shared.upload.users == 0
+
+if __name__ == '__main__':
+    test()
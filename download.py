@@ -1,7 +1,9 @@
 import os
+import math
+import time
+import random
 import logging
 import binascii
-import itertools
 from collections import OrderedDict
 from collections import namedtuple
 
@@ -9,27 +11,76 @@ import peer
 import bencode
 import connection
 import metainfo
+import picker
 import storage
+import swarm
 import tracker
 
+import bitarray
 import gevent
+import gevent.lock
+import gevent.pool
 import gevent.queue
+import gevent.server
 
 log = logging.getLogger('download')
 
 def metadata_request(conn, piece):
-    obj = OrderedDict(msg_type=0, piece=piece)
-    conn.send_cmd('extended', cmd=peer.UT_METADATA, msg=bencode.encode(obj))
+    ''' Request a piece, using the message ID from the peer's extended handshake. '''
+    obj = OrderedDict([('msg_type', 0), ('piece', piece)])
+    conn.send_cmd('extended', cmd=conn.state['ut_metadata'], msg=bencode.encode(obj))
+
+def metadata_reply(conn, piece, metadata):
+    ''' Answer a request with a piece of `metadata` (see metadata_pieces),
+        or reject it if we don't have it.
+    '''
+    if conn.state.get('ut_metadata') is None:
+        log.debug('{} requested metadata without an extended handshake'.format(conn.name))
+        return
+
+    messages = metadata[1] if metadata is not None else []
+    if isinstance(piece, (int, long)) and 0 <= piece < len(messages):
+        msg = messages[piece]
+    else:
+        msg = bencode.encode(OrderedDict([('msg_type', 2), ('piece', piece)]))
+    conn.send_cmd('extended', cmd=conn.state['ut_metadata'], msg=msg)
+
+def parse_extended(msg):
+    ''' Decode the dictionary heading an extended message from a peer, and
+        return it with the offset of the data following it (if any).
+        Raise bencode.Error if the message does not start with a dictionary.
+    '''
+    d, offset = bencode.decode_prefix(msg)
+    if not isinstance(d, dict):
+        raise bencode.Error('extended message is not a dictionary: {!r}'.format(d))
+    return d, offset
+
+def metadata_id(handshake):
+    ''' Return the peer's ut_metadata message ID from its extended handshake,
+        or None if it does not support it.
+    '''
+    m = handshake.get('m')
+    msg_id = m.get('ut_metadata') if isinstance(m, dict) else None
+    if isinstance(msg_id, (int, long)) and 0 < msg_id < 256:
+        return msg_id
+
+def metadata_pieces(data):
+    ''' Return (size, messages): the size of the metadata `data`, and the
+        ut_metadata data message of each of its pieces.
+    '''
+    n = Metadata.piece_size
+    messages = []
+    for offset in xrange(0, len(data), n):
+        header = OrderedDict([('msg_type', 1), ('piece', offset // n), ('total_size', len(data))])
+        messages.append(bencode.encode(header) + data[offset:offset+n])
+    return (len(data), messages)
 
 def metadata_save(data):
-    info_hash = metainfo.hash(data)
-    h = binascii.hexlify(info_hash)
+    meta = metainfo.MetaInfo(bencode.decode(data), raw=data)
+    h = binascii.hexlify(meta.info_hash)
     log.info('saving metadata for {}'.format(h))
     with file(h + '.meta', 'wb') as f: 
         f.write(data)
-
-    meta = metadata_load(info_hash)
-    assert meta is not None # verify correct data is written to file
     return meta
 
 def metadata_load(info_hash):
@@ -41,67 +92,232 @@ def metadata_load(info_hash):
     with file(fname, 'rb') as f: 
         data = f.read()
         
-    if metainfo.hash(data) == info_hash:
-        meta = metainfo.MetaInfo(bencode.decode(data))
+    try:
+        meta = metainfo.MetaInfo(bencode.decode(data), raw=data)
+    except bencode.Error as e:
+        log.warning('invalid metadata in {}: {}'.format(fname, e))
+        return None
+
+    if meta.info_hash == info_hash:
         log.info('MetaInfo "{}" ({} hashes) = {:.1f}MB'.format(meta.name, 
             len(meta.hashes), meta.total / 1e6))
         return meta
 
-def loop(dl, addr):
+def loop(dl, addr, stream=None):
     ''' BitTorrent `Protocol main loop. 
+        Connects to `addr`, unless `stream` is an accepted connection from it.
     '''
+    outgoing = stream is None
+    conn = None
     try:
-        conn = connection.Stream(addr, timeout=60)
-        conn = peer.Connection(conn) # peer message protocol wrapper
-
-        conn.state['am_choking']        = True
-        conn.state['peer_choking']      = True
-        conn.state['am_interested']     = False
-        conn.state['peer_interested']   = False
-        
-        # Handshake with peer        
-        dl.handshake(conn)
-
+        with dl.connecting: # bound the number of half-open connections
+            if outgoing:
+                stream = connection.Stream(addr, timeout=60)
+            stream.limit(dl.limits())
+            conn = peer.Connection(stream) # peer message protocol wrapper
+
+            conn.state['am_choking']        = True  # host is choked by the peer
+            conn.state['peer_choking']      = True  # peer is choked by the host
+            conn.state['am_interested']     = False
+            conn.state['peer_interested']   = False
+            
+            # Handshake with peer        
+            dl.handshake(conn)
+
+        if outgoing:
+            dl.swarm.connected(addr)
+        dl.connections.add(conn)
         while True:
             event = conn.recv_cmd()
             result = dl.handle(conn, event)
             if result is not None:
                 return result
 
-    except connection.Closed, e:
+    except (connection.Closed, peer.ParseError, bencode.Error), e:
         log.warning('{} at {}'.format(e, addr))
 
+    finally:
+        if conn is not None:
+            dl.connections.discard(conn)
+            dl.close(conn)
+        if stream is not None:
+            stream.close() # and stop sharing its rate limits
+
 class Downloader:
 
-    def __init__(self, host_id, info_hash):
+    def __init__(self, host_id, info_hash, client=None, max_peers=50, max_connecting=8,
+                 min_interval=60, port=6889, limit=None, global_limit=None,
+                 peer_rates=(None, None), slots=None):
+        ''' Keep up to `max_peers` connections, with at most `max_connecting`
+            of them before the handshake. Trackers are asked for more peers
+            on their interval, but not more often than `min_interval` seconds.
+            `port` is announced to the trackers, and listened on by listen().
+            Transfer rates are limited by `limit` (a connection.Limit of this
+            download), `global_limit` (shared with other downloads) and
+            `peer_rates` (upload, download) for each peer, in bytes/second.
+            `slots` is a semaphore bounding the connections of all the
+            downloads sharing it (by default, there is no such bound).
+        '''
         self.host_id = host_id
         self.info_hash = info_hash
+        self.client = client or tracker.client
+        self.max_peers = max_peers
+        self.min_interval = min_interval
+        self.port = port
+        self.limit = limit or connection.Limit()
+        self.global_limit = global_limit or connection.Limit()
+        self.peer_rates = peer_rates
+        self.connecting = gevent.lock.BoundedSemaphore(max_connecting)
+        self.slots = slots or gevent.lock.DummySemaphore()
+        self.swarm = swarm.Swarm()
+        self.connections = set() # after the handshake, incoming and outgoing
+        self.events = gevent.queue.Queue() # (address, result) of finished connections
+        self.server = None
+        self.incoming = 0 # accepted connections
+        self.accepted = set() # greenlets serving the accepted connections
+
+    def close(self, conn):
+        pass
+
+    def limits(self):
+        ''' Return the rate limits for a new connection. '''
+        return [self.global_limit, self.limit, connection.Limit(*self.peer_rates)]
 
     def get_peers(self, trackers):
+        ''' Yield peers as soon as any of the trackers returns them. '''
         # return [('localhost', 51413)] # test local BT
-        return tracker.get_peers(trackers[0], self.info_hash, self.host_id, num_want=50)
+        return self.client.announce(trackers, self.info_hash, self.host_id,
+                                    num_want=50, port=self.port)
+
+    def listen(self):
+        ''' Accept incoming connections on `port` (0 to pick a free one). '''
+        self.server = gevent.server.StreamServer(('0.0.0.0', self.port), self._accept)
+        self.server.start()
+        self.port = self.server.server_port
+        log.info('listening on port {}'.format(self.port))
+
+    def _accept(self, sock, addr):
+        self.accept(connection.Stream(addr, timeout=60, sock=sock), addr)
+
+    def accept(self, stream, addr):
+        ''' Serve an incoming connection (its handshake may be buffered in `stream` already). '''
+        if len(self.connections) >= self.max_peers or self.slots.locked():
+            log.info('rejecting {}: too many connections'.format(addr))
+            stream.close()
+            return
+        self.incoming += 1
+        self.accepted.add(gevent.getcurrent())
+        try:
+            with self.slots:
+                result = loop(self, addr, stream=stream)
+        finally:
+            self.incoming -= 1
+            self.accepted.discard(gevent.getcurrent())
+        self.events.put( (None, result) ) # wake up run(), as a slot is free
+
+    def announce(self, trackers):
+        ''' Add peers from the trackers to the swarm, re-announcing to each
+            tracker on its own interval (so a dead tracker holds back no other).
+        '''
+        announcers = gevent.pool.Group()
+        try:
+            for url in OrderedDict.fromkeys(trackers):
+                announcers.spawn(self._announce, url)
+            announcers.join()
+        finally:
+            announcers.kill()
+
+    def _announce(self, url):
+        while True:
+            interval = None
+            try:
+                for addr in self.get_peers([url]):
+                    if self.swarm.add(addr):
+                        self.events.put( (None, None) ) # wake up run()
+                interval = self.client.interval([url])
+            except Exception:
+                log.exception('announce to {} failed'.format(url))
+
+            interval = max(interval or self.min_interval, self.min_interval)
+            log.info('{} candidate peers, next announce to {} in {}s'.format(len(self.swarm), url, interval))
+            gevent.sleep(interval)
 
     def run(self, trackers):
-        q = gevent.queue.Queue()
+        q = self.events
         def peer_loop(addr):
-            q.put( (addr, loop(self, addr)) )
+            result = None
+            try:
+                with self.slots:
+                    result = loop(self, addr)
+            finally:
+                q.put( (addr, result) )
 
         greenlets = {}
-        while True:
-
-            if not greenlets:
-                for addr in self.get_peers(trackers):
+        announcer = gevent.spawn(self.announce, trackers)
+        try:
+            while True:
+                # refill the connections from the candidates
+                while len(greenlets) + self.incoming < self.max_peers:
+                    addr = self.swarm.next()
+                    if addr is None:
+                        break
                     greenlets[addr] = gevent.spawn(peer_loop, addr)
-                continue
 
-            addr, result = q.get()
-            greenlets.pop(addr)
-            log.info('{} peers left'.format(len(greenlets)))
-            if result:
-                gevent.killall(greenlets.values())
-                return result
+                # wait for a retry only if there is a free slot for it
+                full = len(greenlets) + self.incoming >= self.max_peers
+                try:
+                    addr, result = q.get(timeout=None if full else self.swarm.wait_time())
+                except gevent.queue.Empty:
+                    continue # some candidate is ready to be retried
+
+                if addr is None:
+                    if result:
+                        return result # from an incoming connection
+                    continue # new candidates, or a closed incoming connection
+
+                greenlets.pop(addr)
+                self.swarm.disconnected(addr)
+                log.info('{} peers left'.format(len(greenlets)))
+                if result:
+                    return result
+        finally:
+            announcer.kill()
+            gevent.killall(list(self.accepted))
+            gevent.killall(greenlets.values())
+            # so another run() (e.g. seeding after the download) starts afresh
+            for addr in greenlets:
+                self.swarm.disconnected(addr)
+            while not q.empty(): # events of the killed connections
+                q.get()
 
 class Metadata(Downloader):
+    ''' Downloads the info dictionary of a magnet link from peers (BEP 9).
+
+    The size advertised in the extended handshake determines the pieces,
+    which are requested from several peers at once (distinct pieces first).
+    Rejected or timed-out pieces are requested from other peers, and the
+    metadata is hashed once, when all of its pieces are present.
+    '''
+    piece_size = 2**14
+    max_size = 2**26 # larger metadata is not trusted
+
+    def __init__(self, host_id, info_hash, max_requests=2, timeout=10, **kw):
+        ''' At most `max_requests` pieces are requested from each peer, and
+            requests are considered lost after `timeout` seconds.
+        '''
+        Downloader.__init__(self, host_id, info_hash, **kw)
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.size = None
+        self.pieces = None   # index -> data (None if missing)
+        self.requested = {}  # index -> {connection: time requested}
+
+    def run(self, trackers):
+        watchdog = gevent.spawn(self._watchdog)
+        try:
+            return Downloader.run(self, trackers)
+        finally:
+            watchdog.kill()
 
     def handshake(self, conn):
         host_exts = set(peer.extensions[k] for k in ['commands'])
@@ -111,79 +327,341 @@ class Metadata(Downloader):
         
         obj = OrderedDict(m=peer.extended_commands)
         conn.send_cmd('extended', cmd=0, msg=bencode.encode(obj))
+        conn.state['metadata_requests'] = set()
 
+    def close(self, conn):
+        for index in conn.state.get('metadata_requests', ()):
+            self.requested[index].pop(conn, None)
 
     def handle(self, conn, event):
 
         if event.name in {'unchoke', 'choke'}:
             conn.state['am_choking'] = (event.name == 'choke')
             log.info('host is {}d by {}'.format(event.name, conn.name))
-
-            metadata_request(conn, piece=0)
-            conn.state['metadata'] = []
             return
 
         if event.name == 'extended':
+            if event.cmd == 0: # extended handshake
+                d, _ = parse_extended(event.msg)
+                conn.state['ut_metadata'] = metadata_id(d)
+                self._set_size(conn, d.get('metadata_size'))
+                self._request(conn)
+
             if event.cmd == peer.UT_METADATA:
-                d, piece = bencode._decode(event.msg)
+                d, offset = parse_extended(event.msg)
+                msg_type = d.get('msg_type')
+                if msg_type == 0: # request
+                    metadata_reply(conn, d.get('piece'), None) # not available yet
+                    return
+
+                index = d.get('piece')
+                if not isinstance(index, (int, long)) or index not in conn.state['metadata_requests']:
+                    log.debug('unexpected metadata message from {}: {}'.format(conn.name, d))
+                    return
+                conn.state['metadata_requests'].discard(index)
+                self.requested[index].pop(conn, None)
+
+                if msg_type == 1: # data
+                    piece = event.msg[offset:]
+                    log.info('got {} bytes of metadata from {}'.format(len(piece), conn.name))
+                    if len(piece) != min(self.piece_size, self.size - index * self.piece_size):
+                        log.warning('invalid metadata piece #{} from {}'.format(index, conn.name))
+                        conn.state['ut_metadata'] = None # don't ask this peer again
+                    elif self.pieces[index] is None:
+                        self.pieces[index] = str(piece)
+                        if all(p is not None for p in self.pieces):
+                            return self._complete()
 
-                if d['msg_type'] == 0: # request
-                    log.warning('unsupported')
+                if msg_type == 2: # reject
+                    log.warning('{} rejected metadata piece #{}'.format(conn.name, index))
+                    conn.state['ut_metadata'] = None # don't ask this peer again
 
-                if d['msg_type'] == 1: # data
-                    log.info('got {} bytes of metadata from {}'.format(len(piece), conn.name))
-                    pieces = conn.state['metadata']
-                    pieces.append(piece)
-                    data = ''.join(pieces)
-                    if self.info_hash == metainfo.hash(data):
-                        return metadata_save(data)
-                    else:
-                        metadata_request(conn, piece=d['piece']+1)
+                self._refill()
+
+            return
+
+    def _set_size(self, conn, size):
+        if self.size is not None:
+            if size != self.size:
+                log.warning('{} has metadata of {} bytes, not {}'.format(conn.name, size, self.size))
+                conn.state['ut_metadata'] = None
+            return
+
+        if not isinstance(size, (int, long)) or not 0 < size <= self.max_size:
+            log.warning('{} has no valid metadata size: {!r}'.format(conn.name, size))
+            conn.state['ut_metadata'] = None
+            return
 
-                if d['msg_type'] == 2: # reject
-                    log.warning('no metadata')
+        self.size = size
+        n = -(-size // self.piece_size) # round up
+        self.pieces = [None] * n
+        self.requested = {i: {} for i in xrange(n)}
+        log.info('metadata has {} bytes ({} pieces)'.format(size, n))
 
+    def _request(self, conn):
+        ''' Request missing pieces from this peer: unrequested pieces first,
+            then pieces whose requests timed out elsewhere.
+        '''
+        if conn.state.get('ut_metadata') is None or self.pieces is None:
             return
 
+        pending = conn.state['metadata_requests']
+        now = time.time()
+        missing = [i for i, p in enumerate(self.pieces) if p is None and i not in pending]
+        missing.sort(key=lambda i: (len(self.requested[i]) > 0, min(self.requested[i].values() or [0])))
+        for index in missing:
+            if len(pending) >= self.max_requests:
+                break
+            requests = self.requested[index]
+            if requests and min(requests.values()) > now - self.timeout:
+                break # all the others are pending elsewhere, and not late yet
+
+            log.debug('requesting metadata piece #{} from {}'.format(index, conn.name))
+            metadata_request(conn, piece=index)
+            pending.add(index)
+            requests[conn] = now
+
+    def _refill(self):
+        for conn in list(self.connections):
+            try:
+                self._request(conn)
+            except connection.Closed, e:
+                log.debug('{} at peer {}'.format(e, conn.name)) # its own greenlet will close it
+
+    def _watchdog(self):
+        ''' Request timed-out pieces from other peers. '''
+        while True:
+            gevent.sleep(self.timeout / 2.0)
+            self._refill()
+
+    def _complete(self):
+        data = ''.join(self.pieces)
+        if self.info_hash == metainfo.hash(data):
+            return metadata_save(data)
+
+        log.warning('metadata hash mismatch, downloading again')
+        self.pieces = [None] * len(self.pieces)
+        self._refill()
 
 Request = namedtuple('Request', ['index', 'begin', 'length'])
 
-def take(iterable, n):
-    return list(itertools.islice(iterable, n))
+class Pipeline:
+    ''' Number of blocks to keep requested from a single peer.
 
-class Torrent(Downloader):
+    The depth tracks the bandwidth-delay product of the peer: its measured
+    download rate times twice its minimal request-to-piece latency (the
+    minimum excludes time spent queued behind our own earlier requests).
+    While the rate is limited by the depth itself, this doubles the depth
+    on every update, until the peer's bandwidth is saturated.
+    '''
+    def __init__(self, block_size, min_depth, max_depth, depth=2**3, interval=0.5, alpha=0.5):
+        self.block_size = block_size
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.interval = interval # seconds between rate updates
+        self.alpha = alpha       # weight of the latest rate sample
+
+        self.depth = max(min_depth, min(max_depth, depth))
+        self.rate = None         # bytes/second (moving average)
+        self.latency = None      # seconds (minimal)
+
+        self._sent = {}          # request -> time it was sent
+        self._window = (None, 0) # (start time, bytes received since)
+
+    def sent(self, req, now=None):
+        now = time.time() if now is None else now
+        self._sent[req] = now
+        if self._window[0] is None:
+            self._window = (now, 0)
+
+    def discard(self, req):
+        self._sent.pop(req, None)
+        if not self._sent:
+            self._window = (None, 0) # don't count idle time
+
+    def received(self, req, size, now=None):
+        now = time.time() if now is None else now
+        sent = self._sent.pop(req, None)
+        if sent is not None:
+            latency = now - sent
+            self.latency = latency if self.latency is None else min(self.latency, latency)
+
+        start, total = self._window
+        if start is None:
+            return
+        total = total + size
+        elapsed = now - start
+        if elapsed < self.interval:
+            self._window = (start, total)
+            return
 
-    def __init__(self, host_id, meta):
-        Downloader.__init__(self, host_id, meta.info_hash)
-        self.data = storage.Data(meta)
+        rate = total / elapsed
+        self.rate = rate if self.rate is None else self.alpha * rate + (1 - self.alpha) * self.rate
+        self._window = (now, 0) if self._sent else (None, 0)
+        if self.latency is not None:
+            self._update()
+
+    def _update(self):
+        depth = int(math.ceil(self.rate * 2 * self.latency / self.block_size))
+        self.depth = max(self.min_depth, min(self.max_depth, depth))
+
+class Choker:
+    ''' Tit-for-tat: the `slots` interested peers with the best rates are
+        unchoked, plus one random interested peer (the optimistic unchoke),
+        which is replaced every `optimistic_rounds` rounds, so that new peers
+        get a chance to show their rates.
+    '''
+    def __init__(self, slots=4, optimistic_rounds=3):
+        self.slots = slots
+        self.optimistic_rounds = optimistic_rounds
+        self.optimistic = None
+        self.rounds = 0
+
+    def select(self, rates, interested):
+        ''' Return the set of peers to unchoke, given {peer: rate} and the interested peers. '''
+        best = sorted(interested, key=lambda p: rates.get(p, 0), reverse=True)
+        unchoked = set(best[:self.slots])
+
+        if self.rounds % self.optimistic_rounds == 0 or self.optimistic not in interested:
+            others = best[self.slots:]
+            self.optimistic = random.choice(others) if others else None
+        self.rounds += 1
+
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+        return unchoked
 
-        piece_indices = storage.indices(~self.data.bits) # indices to missing pieces
+class Torrent(Downloader):
 
-        self.queue_size = 2**3
+    def __init__(self, host_id, meta, min_queue_size=2**1, max_queue_size=2**8,
+                 max_buffer_size=2**26, max_cache_size=2**26, allocation='sparse',
+                 backend='file', priorities=None, io=None, client=None, port=6889,
+                 upload_slots=4, choke_interval=10, request_horizon=2, listen=True, **kw):
+        ''' `priorities` are per-file (0 to skip a file, higher is more important).
+            `io` is the storage.DiskIO to run disk jobs on (by default, a private one),
+            and `client` the tracker.Client to announce with.
+            Peers are rechoked every `choke_interval` seconds (see Choker).
+            Under a download limit, no more blocks are requested from a peer
+            than it may send within `request_horizon` seconds.
+            Without `listen`, incoming connections are passed to accept()
+            by someone else (e.g. a session.Session).
+            Rate limits and peer bounds are passed to Downloader.
+        '''
+        Downloader.__init__(self, host_id, meta.info_hash, client=client, port=port, **kw)
+        self.data = storage.backends[backend](meta, allocation=allocation,
+                                              priorities=priorities, io=io)
+        # pieces are assembled in memory, up to max_buffer_size bytes
+        self.pieces = storage.PieceBuffer(self.data, max_size=max_buffer_size)
+        # pieces read for uploading are cached, up to max_cache_size bytes
+        self.cache = storage.ReadCache(self.data, max_size=max_cache_size)
+
+        self.priorities = storage.piece_priorities(meta, priorities)
+        self.wanted = bitarray.bitarray([p > 0 for p in self.priorities], endian='big')
+        piece_indices = storage.indices(self.wanted & ~self.data.bits) # indices to missing pieces
+
+        # bounds on the number of requests pending per peer (see Pipeline)
+        self.min_queue_size = min_queue_size
+        self.max_queue_size = max_queue_size
         self.block_size = 2**14
+        self.request_horizon = request_horizon
+
+        # pending request -> connections it was sent to (several only in endgame)
+        self.requests = {}
+        self.max_duplicates = 3 # peers to request the same block from, in endgame
+
+        self.picker = picker.Picker(len(meta.hashes), self._num_blocks,
+                                    wanted=piece_indices, priorities=self.priorities)
+
+        self.listening = listen
+        self.choker = Choker(slots=upload_slots)
+        self.choke_interval = choke_interval
+        self._choke_time = time.time()
 
-        # requests data structure: maps request to peers it was sent to
-        self.reqs = OrderedDict( (req, set()) for req in self._create_reqs(piece_indices) )
-        log.debug('created {} requests'.format(len(self.reqs)))
+        # served to peers which joined by a magnet link
+        self.metadata = metadata_pieces(meta.raw)
+
+    def run(self, trackers):
+        ''' Download until done, uploading to the peers we choose meanwhile.
+            When already done, this only seeds (until killed).
+        '''
+        if self.listening:
+            self.listen()
+        choker = gevent.spawn(self._choke_loop)
+        try:
+            return Downloader.run(self, trackers)
+        finally:
+            choker.kill()
+            if self.listening and self.server is not None:
+                self.server.stop()
+                self.server = None
 
     def handshake(self, conn):
 
-        conn.handshake(info_hash=self.info_hash, host_id=self.host_id, extensions=[])
+        host_exts = [peer.extensions['commands']]
+        peer_exts = conn.handshake(info_hash=self.info_hash, host_id=self.host_id,
+                                   extensions=host_exts)
         conn.send_cmd('bitfield', bits=self.data.bits.tobytes())
-        conn.send_cmd('unchoke')
+        if set(host_exts).issubset(peer_exts):
+            obj = OrderedDict([('m', peer.extended_commands), ('metadata_size', self.metadata[0])])
+            conn.send_cmd('extended', cmd=0, msg=bencode.encode(obj))
         conn._pending_requests = set()
+        conn._pipeline = Pipeline(self.block_size, self.min_queue_size, self.max_queue_size)
+        conn._uploaded = conn._downloaded = 0 # bytes of blocks
+        conn._choke_bytes = (0, 0) # (uploaded, downloaded) at the last rechoke
 
-    def download(self, conn, choke=None, bits=None, piece=None):
+    def _choke_loop(self):
+        while True:
+            gevent.sleep(self.choke_interval)
+            self._rechoke()
+
+    def _rechoke(self):
+        ''' Unchoke the peers we download from the fastest (or, when seeding,
+            upload to the fastest), and choke the rest.
+        '''
+        now = time.time()
+        elapsed = max(now - self._choke_time, 1e-3)
+        self._choke_time = now
+
+        seeding = self.done()
+        rates = {}
+        for conn in self.connections:
+            uploaded, downloaded = conn._choke_bytes
+            if seeding:
+                rates[conn] = (conn._uploaded - uploaded) / elapsed
+            else:
+                rates[conn] = (conn._downloaded - downloaded) / elapsed
+            conn._choke_bytes = (conn._uploaded, conn._downloaded)
+
+        interested = [conn for conn in self.connections if conn.state['peer_interested']]
+        unchoked = self.choker.select(rates, interested)
+        log.debug('unchoking {} of {} interested peers'.format(len(unchoked), len(interested)))
+        for conn in list(self.connections):
+            self._choke(conn, conn not in unchoked)
+
+    def _choke(self, conn, choke):
+        if conn.state['peer_choking'] == choke:
+            return
+        conn.state['peer_choking'] = choke
+        log.info('peer {} is {} by host'.format(conn.name, 'choked' if choke else 'unchoked'))
+        try:
+            conn.send_cmd('choke' if choke else 'unchoke')
+        except connection.Closed, e:
+            log.debug('{} at peer {}'.format(e, conn.name)) # its own greenlet will close it
+
+    def _have(self, index):
+        ''' Let all the peers know we have a new piece. '''
+        for conn in list(self.connections):
+            try:
+                conn.send_cmd('have', index=index)
+            except connection.Closed, e:
+                log.debug('{} at peer {}'.format(e, conn.name))
 
+    def download(self, conn, choke=None, bits=None, piece=None):
+        ''' Return True if `piece` completed the last wanted piece. '''
         if choke is not None:
             # handle choke/unchoke message
             if choke:
-                while conn._pending_requests:
-                    req = conn._pending_requests.pop()
-                    log.info('flush {} '.format(req))
-                    peers = self.reqs.get(req)
-                    if peers and conn.peer_id in peers:
-                        peers.remove(conn.peer_id)
+                self._flush(conn)
 
             else: # unchoke
                 self._request(conn)
@@ -193,37 +671,126 @@ class Torrent(Downloader):
 
         if piece is not None: # handle piece message
             req = Request(piece.index, piece.begin, len(piece.data))
+            if req not in conn._pending_requests:
+                # already received from another peer (in endgame), or never requested
+                log.debug('peer {} sent unexpected {}'.format(conn.name, req))
+                return
+
             conn._pending_requests.remove(req)
-            peers = self.reqs.pop(req)
-            assert peers == set([conn.peer_id]) # we expect only one request per block
-            if all(r not in self.reqs for r in self._create_reqs([req.index])):
-                # all requests of this piece are recieved
-                self.data.validate([req.index])
+            conn._pipeline.received(req, req.length)
+            conn._downloaded += req.length
+            log.debug('peer {} pipeline depth {}'.format(conn.name, conn._pipeline.depth))
+            for other in self.requests.pop(req):
+                if other is not conn:
+                    self._cancel(other, req)
+
+            completed = False
+            self.pieces.write(index=piece.index, begin=piece.begin, data=piece.data)
+            if self.picker.received(req.index, req.begin // self.block_size):
+                # all blocks of this piece are received
+                if self.pieces.validate(req.index):
+                    self.picker.complete(req.index)
+                    self._have(req.index)
+                    log.debug('disk I/O: {}'.format(self.data.io))
+                    completed = self.done()
+                else:
+                    self.picker.reset(req.index)
 
             self._request(conn)
+            return completed
 
     def _request(self, conn):
 
         if conn.state['am_choking']:
             return # this peer is choked
 
-        while len(conn._pending_requests) < self.queue_size:
-            peer_bits = conn.state['peer_bits']
-            bits = peer_bits & ~self.data.bits
-            if not any(bits): 
-                return # this peer has no useful pieces
-
-            # requests for blocks the peer has, and the host does not, and were not requsted yet
-            reqs = (r for r, peers in self.reqs.items() if bits[r.index] and len(peers) == 0)
-            reqs = take(reqs, 1)
-            if not reqs:
-                return # no additional requests should be made
+        peer_bits = conn.state.get('peer_bits')
+        if peer_bits is None:
+            return # this peer has no pieces
+
+        depth = self._depth(conn)
+        while len(conn._pending_requests) < depth:
+            block = self.picker.pick(peer_bits)
+            if block is None:
+                break # this peer has no useful blocks, which were not requested yet
+            self._send_request(conn, self._create_req(*block))
+
+        if self.picker.endgame():
+            self._request_endgame(conn, peer_bits)
+
+    def _depth(self, conn):
+        ''' Return how many requests may be pending at this peer. '''
+        depth = conn._pipeline.depth
+        rate = conn.conn.download_rate()
+        if rate is not None: # don't queue more than the download limits let through
+            depth = min(depth, max(self.min_queue_size,
+                                   int(rate * self.request_horizon) // self.block_size))
+        return depth
+
+    def _request_endgame(self, conn, peer_bits):
+        ''' Request blocks which are pending at other peers (the least requested first),
+            so the last pieces don't depend on the slowest peer.
+        '''
+        free = self._depth(conn) - len(conn._pending_requests)
+        if free <= 0:
+            return
 
-            req, = reqs
-            log.debug('requesting #{} @ {} [{:.1f}kB] from peer {}'.format(req.index, req.begin, req.length / 1e3, conn.name))
-            self.reqs[req].add( conn.peer_id )
-            conn.send_cmd('request', **vars(req))
-            conn._pending_requests.add(req)            
+        candidates = sorted((len(conns), req) for req, conns in self.requests.iteritems()
+                            if len(conns) < self.max_duplicates and
+                            conn not in conns and peer_bits[req.index])
+        for _, req in candidates[:free]:
+            log.debug('endgame: {} is also requested from peer {}'.format(req, conn.name))
+            self._send_request(conn, req)
+
+    def _send_request(self, conn, req):
+        log.debug('requesting #{} @ {} [{:.1f}kB] from peer {}'.format(req.index, req.begin, req.length / 1e3, conn.name))
+        # recorded before sending, so it is released by _flush() if sending fails
+        conn._pending_requests.add(req)
+        conn._pipeline.sent(req)
+        self.requests.setdefault(req, set()).add(conn)
+        conn.send_cmd('request', **vars(req))
+
+    def _cancel(self, conn, req):
+        ''' The block was received from another peer. '''
+        conn._pending_requests.discard(req)
+        conn._pipeline.discard(req)
+        log.debug('cancel {} at peer {}'.format(req, conn.name))
+        try:
+            conn.send_cmd('cancel', **vars(req))
+            self._request(conn) # refill its pipeline
+        except connection.Closed, e:
+            log.debug('{} at peer {}'.format(e, conn.name)) # its own greenlet will close it
+
+    def _flush(self, conn):
+        ''' Release the blocks requested from this peer, to be requested elsewhere. '''
+        released = False
+        while conn._pending_requests:
+            req = conn._pending_requests.pop()
+            conn._pipeline.discard(req)
+            log.info('flush {} '.format(req))
+            conns = self.requests.get(req)
+            conns.discard(conn)
+            if not conns: # not pending at other peers
+                del self.requests[req]
+                self.picker.release(req.index, req.begin // self.block_size)
+                released = True
+
+        if released: # other peers may be idle, having nothing else to request
+            for other in list(self.connections):
+                if other is conn:
+                    continue
+                try:
+                    self._request(other)
+                except connection.Closed, e:
+                    log.debug('{} at peer {}'.format(e, other.name)) # its own greenlet will close it
+
+    def close(self, conn):
+        if not hasattr(conn, '_pending_requests'):
+            return # handshake was not completed
+        self._flush(conn)
+        peer_bits = conn.state.get('peer_bits')
+        if peer_bits is not None:
+            self.picker.remove(peer_bits)
 
     def handle(self, conn, event):
         if event.name in {'unchoke', 'choke'}:
@@ -232,19 +799,29 @@ class Torrent(Downloader):
             self.download( conn, choke=conn.state['am_choking'] )
             return
 
-        if event.name == {'interested', 'uninterested'}:
+        if event.name in {'interested', 'uninterested'}:
             conn.state['peer_interested'] = (event.name == 'interested')
             log.info('peer {} is {}'.format(conn.name, event.name))
+
+            # don't wait for the next rechoke while there are free upload slots
+            unchoked = sum(1 for c in self.connections if not c.state['peer_choking'])
+            if conn.state['peer_interested'] and unchoked < self.choker.slots + 1:
+                self._choke(conn, False)
             return
 
         if event.name in {'bitfield', 'have'}:
+            peer_bits = conn.state.get('peer_bits')
             if event.name == 'bitfield':
+                if peer_bits is not None:
+                    self.picker.remove(peer_bits)
                 peer_bits = storage.bitfield(event.bits, n=len(self.data.meta.hashes))
+                self.picker.add(peer_bits)
             else: # have
-                peer_bits = conn.state.get('peer_bits')
                 if peer_bits is None:
                     peer_bits = storage.bitfield(None, n=len(self.data.meta.hashes))
-                peer_bits[event.index] = True
+                if not peer_bits[event.index]:
+                    peer_bits[event.index] = True
+                    self.picker.have(event.index)
 
             log.debug('peer {} has {} of {} pieces'.format(conn.name, 
                 peer_bits.count(), peer_bits.length()))
@@ -252,7 +829,7 @@ class Torrent(Downloader):
             conn.state['peer_bits'] = peer_bits
             self.download( conn, bits=peer_bits )
 
-            needed = peer_bits & ~self.data.bits
+            needed = peer_bits & self.wanted & ~self.data.bits
             log.debug('peer {} has {} needed pieces'.format(conn.name, needed.count()))
 
             if any(needed) and conn.state['am_interested'] == False:
@@ -271,32 +848,146 @@ class Torrent(Downloader):
 
         if event.name == 'piece':
             log.debug('downloaded #{} @ {} [{:.1f}kB] from {}'.format(event.index, event.begin, len(event.data) / 1e3, conn.name))
-            self.data.write(index=event.index, begin=event.begin, data=event.data)
-            self.download( conn, piece=event )            
-            if all(self.data.bits):
+            if self.download( conn, piece=event ):
                 return self.data # and stop download
 
             return
 
         if event.name == 'request':
             log.debug('peer {} request #{} @ {} [{:.1f}kB]'.format(conn.name, event.index, event.begin, event.length / 1e3))
-            data = self.data.read(index=event.index, begin=event.begin, size=event.length)
+            if conn.state['peer_choking']:
+                log.debug('peer {} is choked, ignoring its request'.format(conn.name))
+                return
+
+            if not (0 <= event.index < len(self.data.bits) and self.data.bits[event.index]):
+                log.warning('peer {} requested missing piece #{}'.format(conn.name, event.index))
+                return
+
+            if not (event.begin >= 0 and event.length > 0 and
+                    event.begin + event.length <= self.data.piece_size(event.index)):
+                log.warning('peer {} requested invalid range #{} @ {} [{}B]'.format(
+                    conn.name, event.index, event.begin, event.length))
+                return
+
+            data = self.cache.read(index=event.index, begin=event.begin, size=event.length)
 
             conn.send_cmd('piece', index=event.index, begin=event.begin, data=data)
+            conn._uploaded += len(data)
             log.debug('peer {} upload  #{} @ {} [{:.1f}kB]'.format(conn.name, event.index, event.begin, len(data) / 1e3))
             return
 
+        if event.name == 'extended':
+            d, _ = parse_extended(event.msg)
+            if event.cmd == 0: # extended handshake
+                conn.state['ut_metadata'] = metadata_id(d)
+            elif event.cmd == peer.UT_METADATA and d.get('msg_type') == 0:
+                log.debug('peer {} requested metadata piece #{}'.format(conn.name, d.get('piece')))
+                metadata_reply(conn, d.get('piece'), self.metadata)
+            return
+
         if event.name == 'keep_alive':
             log.debug('got keep alive from peer {}'.format(conn.name))
             return
 
+        if event.name == 'cancel':
+            return # requests are served as they arrive, so there is nothing to cancel
+
         log.warning('unsupported event: {}'.format(event.name))
 
-    def _create_reqs(self, piece_indices):
-        for index in piece_indices:
-            piece_size = self.data.piece_size(index)
-            offset = 0
-            while offset < piece_size:
-                size = min(self.block_size, piece_size - offset)
-                yield Request(index, offset, size)
-                offset = offset + size
+    def done(self):
+        ''' Return whether all the wanted pieces were downloaded. '''
+        return not any(self.wanted & ~self.data.bits)
+
+    def _num_blocks(self, index):
+        return -(-self.data.piece_size(index) // self.block_size) # round up
+
+    def _create_req(self, index, block):
+        begin = block * self.block_size
+        size = min(self.block_size, self.data.piece_size(index) - begin)
+        return Request(index, begin, size)
+
+## Unittests
+
+def test():
+    from gevent import socket
+
+    class Idle(Downloader):
+        def handshake(self, conn):
+            pass
+        def handle(self, conn, event):
+            pass
+
+    # a closed connection stops sharing the rate limits
+    dl = Idle('h' * 20, 'i' * 20, limit=connection.Limit(download=2**20))
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    g = gevent.spawn(loop, dl, server.getsockname())
+    sock, _ = server.accept()
+    gevent.sleep(0.1)
+    assert dl.limit.download.users == 1 and len(dl.connections) == 1
+    sock.close() # the peer disconnects
+    g.join(timeout=5)
+    assert g.dead and not dl.connections
+    assert dl.limit.download.users == dl.global_limit.download.users == 0
+    server.close()
+
+    # a full pool waits for a free slot, instead of polling for ready candidates
+    class Events(gevent.queue.Queue):
+        gets = 0
+        def get(self, *args, **kw):
+            Events.gets += 1
+            return gevent.queue.Queue.get(self, *args, **kw)
+
+    dl = Idle('h' * 20, 'i' * 20, max_peers=1)
+    dl.events = Events()
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    dl.swarm.add(server.getsockname())
+    dl.swarm.add(('127.0.0.1', 1))
+    g = gevent.spawn(dl.run, [])
+    sock, _ = server.accept()
+    gevent.sleep(0.2)
+    assert len(dl.connections) == 1 and Events.gets < 10, Events.gets
+    g.kill()
+    sock.close()
+    server.close()
+
+    # accepted connections are closed when run() ends
+    dl = Idle('h' * 20, 'i' * 20, port=0)
+    dl.listen()
+    g = gevent.spawn(dl.run, [])
+    sock = socket.create_connection(('127.0.0.1', dl.port))
+    gevent.sleep(0.1)
+    assert dl.incoming == 1 and len(dl.accepted) == 1
+    g.kill()
+    assert dl.incoming == 0 and not dl.accepted and not dl.connections
+    assert sock.recv(1 << 16) == '' # closed by the host
+    sock.close()
+    dl.server.stop()
+
+    # malformed extended messages drop the peer, odd fields are ignored
+    assert metadata_id(bencode.decode('d1:md11:ut_metadatai3eee')) == 3
+    for handshake in ['de', 'd1:mi1ee', 'd1:md11:ut_metadata1:xee', 'd1:md11:ut_metadatai256eee']:
+        assert metadata_id(bencode.decode(handshake)) is None
+    for msg, dropped in [('garbage', True), ('li1ee', True), ('dlee1:xe', True), ('d1:m1:xe', False),
+                         ('d8:msg_type1:x5:pieceli0eee', False)]:
+        dl = Metadata('h' * 20, 'i' * 20)
+        dl.handshake = lambda conn: conn.state.update(metadata_requests=set())
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        g = gevent.spawn(loop, dl, server.getsockname())
+        sock, _ = server.accept()
+        for cmd in [0, peer.UT_METADATA]:
+            sock.sendall(peer.build_command('extended', cmd=cmd, msg=msg))
+        g.join(timeout=0.5)
+        assert g.dead == dropped, msg
+        sock.close()
+        g.join(timeout=5)
+        assert g.successful() and not dl.connections, msg
+        server.close()
+
+if __name__ == '__main__':
+    test()
@@ -45,14 +45,36 @@ def parse_magnet(link):
     
     return {'name': name, 'info_hash': info_hash, 'trackers': trackers}
 
+def parse_torrent(data):
+    ''' Parse the contents of a .torrent file, hashing the raw info dict bytes.
+    '''
+    spans = {'info': None}
+    torrent = bencode.decode(data, spans=spans)
+    if spans['info'] is None:
+        raise ParseError('Missing info dictionary')
+    begin, end = spans['info']
+    return MetaInfo(torrent['info'], raw=data[begin:end])
+
 class MetaInfo:
-    def __init__(self, info):
-        self.info_hash = hash(bencode.encode(info))
+    def __init__(self, info, raw=None):
+        ''' `raw` is the bencoded info dict, as received from the swarm.
+            Its hash is the info hash; re-encoding `info` is a fallback,
+            which is only correct if it round-trips exactly.
+        '''
+        if raw is None:
+            raw = bencode.encode(info)
+        self.raw = raw
+        self.info_hash = hash(raw)
         self.name = info['name']
+        # list of (path components, length), in the order of the torrent's data
         if 'length' in info:
-            self.total = info['length']
+            self.files = [([self.name], info['length'])]
         if 'files' in info:
-            self.total = sum(f['length'] for f in info['files'])
+            self.files = [([self.name] + f['path'], f['length']) for f in info['files']]
+        for path, length in self.files:
+            if any(p in ('', '.', '..') or '/' in p or '\\' in p for p in path):
+                raise ParseError('Invalid file path {!r}'.format(path))
+        self.total = sum(length for path, length in self.files)
 
         self.hashes = piece_hashes(info['pieces'])
         self.piece_length = info['piece length']
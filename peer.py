@@ -1,3 +1,4 @@
+import struct
 import collections
 import construct as c
 import bitarray
@@ -12,6 +13,8 @@ _handshake = c.Struct('handshake',
     c.Bytes('info_hash', 20),   # 160 bit hash
     c.Bytes('peer_id', 20))     # 160 bit hash
 
+HANDSHAKE_SIZE = len(_HANDSHAKE_PREFIX) + 8 + 20 + 20
+
 # Reserved bitfield options
 extensions = { 
     'commands': 20, # support for Extension Protocol (BEP 0010)
@@ -21,37 +24,54 @@ extensions = {
 UT_METADATA = 3
 extended_commands = collections.OrderedDict(ut_metadata=UT_METADATA)
 
-_message = c.Struct('message', 
-        c.UBInt32('length'), 
-        c.Bytes('payload', lambda ctx: ctx.length))
-
-Bytes = lambda name: c.ExprAdapter(c.OptionalGreedyRange(c.StaticField(name, 1)), 
-    encoder=lambda obj, ctx : list(obj),
-    decoder=lambda obj, ctx : ''.join(obj)
-)
-
-_commands = {
-    'choke'         : [c.Magic('\x00')],
-    'unchoke'       : [c.Magic('\x01')],
-    'interested'    : [c.Magic('\x02')],
-    'uninterested'  : [c.Magic('\x03')],
-    'have'          : [c.Magic('\x04'), c.UBInt32('index')],
-    'bitfield'      : [c.Magic('\x05'), Bytes('bits')],
-    'request'       : [c.Magic('\x06'), c.UBInt32('index'), c.UBInt32('begin'), c.UBInt32('length')],
-    'piece'         : [c.Magic('\x07'), c.UBInt32('index'), c.UBInt32('begin'), Bytes('data')],
-    'cancel'        : [c.Magic('\x08'), c.UBInt32('index'), c.UBInt32('begin'), c.UBInt32('length')],
-    'port'          : [c.Magic('\x09'), c.UBInt16('port')],
-    'extended'      : [c.Magic('\x14'), c.UBInt8('cmd'), Bytes('msg')],
-}
-
-for k, v in _commands.items():
-    _commands[k] = c.Struct(k, *v)
+class ParseError(Exception):
+    pass
+
+_length = struct.Struct('>I') # message length prefix
+
+# Message layout: <length prefix><message ID><fixed fields>[<payload>]
+Command = collections.namedtuple('Command', 'name id fmt fields payload view')
+
+_command_list = [
+    #       name            id    header fmt/fields                        payload  view
+    Command('choke',        0x00, '',    (),                               None,    False),
+    Command('unchoke',      0x01, '',    (),                               None,    False),
+    Command('interested',   0x02, '',    (),                               None,    False),
+    Command('uninterested', 0x03, '',    (),                               None,    False),
+    Command('have',         0x04, 'I',   ('index',),                       None,    False),
+    Command('bitfield',     0x05, '',    (),                               'bits',  False),
+    Command('request',      0x06, 'III', ('index', 'begin', 'length'),     None,    False),
+    Command('piece',        0x07, 'II',  ('index', 'begin'),               'data',  True),
+    Command('cancel',       0x08, 'III', ('index', 'begin', 'length'),     None,    False),
+    Command('port',         0x09, 'H',   ('port',),                        None,    False),
+    Command('extended',     0x14, 'B',   ('cmd',),                         'msg',   False),
+]
+
+# Precompiled headers (length prefix, message ID and fixed fields)
+_headers = dict((cmd.name, struct.Struct('>IB' + cmd.fmt)) for cmd in _command_list)
+
+_commands = dict((cmd.name, cmd) for cmd in _command_list)
+_commands_by_id = dict((cmd.id, cmd) for cmd in _command_list)
+
+_KEEP_ALIVE = _length.pack(0)
+
+class Message(dict):
+    ''' Parsed message, with its fields accessible as attributes.
+        (Lighter than construct's Container, which is too slow for piece messages.)
+    '''
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    __setattr__ = dict.__setitem__
 
 def build_handshake(info_hash, host_id, extensions):
 
-    bits = bitarray.bitarray([0]*64, endian='little')
-    for i in extensions:
-        bits[i] = True
+    bits = bitarray.bitarray([0]*64, endian='big')
+    for i in extensions: # numbered from the right (e.g. 20 is reserved[5] & 0x10)
+        bits[63 - i] = True
 
     obj = c.Container(info_hash=info_hash, peer_id=host_id, 
                       reserved=bits.tobytes())
@@ -59,36 +79,57 @@ def build_handshake(info_hash, host_id, extensions):
     return _handshake.build(obj)
 
 def parse_handshake(msg):
-    obj = _handshake.parse(msg)
+    try:
+        obj = _handshake.parse(msg)
+    except c.ConstructError as e:
+        raise ParseError('Invalid handshake: {}'.format(e))
     bits = bitarray.bitarray()
     bits.frombytes(obj.reserved)
     obj.extensions = [i for i, b in enumerate(reversed(bits)) if b]
     return obj
 
-def build_command(name, **kw):    
+def build_command(name, **kw):
     if name == 'keep_alive':
-        return _message.build(c.Container(length=0, payload=''))
+        return _KEEP_ALIVE
 
-    s = _commands[name]
-    obj = c.Container(**kw)
-    payload = s.build(obj)
+    cmd = _commands[name]
+    header = _headers[name]
+    fields = [kw[f] for f in cmd.fields]
+    if cmd.payload is None:
+        return header.pack(header.size - _length.size, cmd.id, *fields)
 
-    return _message.build(c.Container(length=len(payload), payload=payload))
+    payload = kw[cmd.payload]
+    n = header.size - _length.size + len(payload)
+    return header.pack(n, cmd.id, *fields) + str(payload)
 
 def parse_command(msg):
-    obj = _message.parse(msg)
-    cmd = obj.payload
-    if not cmd:
-        return c.Container(name='keep_alive')
-
-    for k, v in _commands.items():
-        try:            
-            obj = v.parse(cmd)
-            obj.name = k
-            return obj
-        except c.ConstructError:
-            pass
-    raise ParseError('cannot parse command')
+    ''' Parse a length-prefixed message.
+        The payload of messages marked as `view` (i.e. piece data) is returned
+        as a zero-copy buffer into `msg`, other payloads as string slices.
+    '''
+    n, = _length.unpack_from(msg)
+    if n != len(msg) - _length.size:
+        raise ParseError('message length {} != {}'.format(n, len(msg) - _length.size))
+    if n == 0:
+        return Message(name='keep_alive')
+
+    msg_id = ord(msg[_length.size])
+    cmd = _commands_by_id.get(msg_id)
+    if cmd is None:
+        return Message(name='unknown', id=msg_id)
+
+    header = _headers[cmd.name]
+    if len(msg) < header.size or (cmd.payload is None and len(msg) != header.size):
+        raise ParseError('invalid {} message length: {}'.format(cmd.name, n))
+
+    values = header.unpack_from(msg)
+    obj = Message(zip(cmd.fields, values[2:]), name=cmd.name)
+    if cmd.payload is not None:
+        if cmd.view:
+            obj[cmd.payload] = buffer(msg, header.size)
+        else:
+            obj[cmd.payload] = msg[header.size:]
+    return obj
 
 log = logging.getLogger('peer')
 
@@ -101,11 +142,9 @@ class Connection:
         self.state = {}
 
     def recv_cmd(self):
-        lentype = c.UBInt32('length')
-        L = self.conn.recv(lentype.sizeof())
-        n = lentype.parse(L)
-        data = self.conn.recv(n)
-        msg = L + data
+        # Messages are parsed in-place from the stream's receive buffer
+        n, = _length.unpack(self.conn.peek(_length.size))
+        msg = self.conn.recv(_length.size + n, view=True)
         return parse_command(msg)
     
     def send_cmd(self, name, **kw):
@@ -139,9 +178,13 @@ class Connection:
         
     
 def test():
-    msg = build_handshake(info_hash='\x01'*20, host_id='\x02'*20)
+    msg = build_handshake(info_hash='\x01'*20, host_id='\x02'*20, extensions=[])
     print repr(parse_handshake(msg))
 
+    msg = build_handshake(info_hash='\x01'*20, host_id='\x02'*20, extensions=[extensions['commands']])
+    assert msg[20:28] == '\x00\x00\x00\x00\x00\x10\x00\x00' # BEP 10
+    assert parse_handshake(msg).extensions == [extensions['commands']]
+
     msg = build_command('request', index=0x05, begin=0x06, length=0x01020304)
     print repr(parse_command(msg))
 
@@ -149,7 +192,17 @@ def test():
     print repr(parse_command(msg))
 
     msg = build_command('piece', index=0, begin=1, data='abcde')
-    print repr(parse_command(msg))
+    obj = parse_command(msg)
+    print repr(obj)
+    assert str(obj.data) == 'abcde'
+    assert build_command('piece', index=0, begin=1, data=obj.data) == msg
+
+    for name in ['choke', 'unchoke', 'interested', 'uninterested']:
+        assert parse_command(build_command(name)).name == name
+    assert parse_command(build_command('keep_alive')).name == 'keep_alive'
+    assert parse_command(build_command('cancel', index=1, begin=2, length=3)).length == 3
+    assert parse_command(build_command('extended', cmd=3, msg='d1:ai1ee')).msg == 'd1:ai1ee'
+    assert parse_command('\x00\x00\x00\x01\xff').name == 'unknown'
 
 if __name__ == '__main__':
     test()
@@ -0,0 +1,163 @@
+import array
+import random
+import logging
+import itertools
+
+import bitarray
+
+log = logging.getLogger('picker')
+
+class Picker:
+    ''' Rarest-first piece picker.
+
+    Tracks the availability of each piece among connected peers, and which
+    blocks of the wanted pieces were not requested yet. Pieces with
+    unrequested blocks are kept in buckets by availability, so the rarest
+    pieces are found without scanning all of them. Ties are broken by
+    starting the scan of a bucket at a random position, and pieces that
+    were already started are preferred, to complete them sooner.
+    Pieces of higher priority are picked before all pieces of lower priority.
+
+    Per-piece state is held in flat arrays, and per-block state only for
+    started pieces, so memory stays small for torrents with millions of blocks.
+    '''
+    def __init__(self, n, num_blocks, wanted, priorities=None):
+        ''' `n` is the number of pieces, `num_blocks(i)` the number of blocks
+            in piece #i, and `wanted` the indices of the pieces to download.
+            `priorities` (per piece, default 1) should be positive for wanted pieces.
+        '''
+        self.num_blocks = num_blocks
+        self.availability = array.array('i', [0]) * n
+        self.priorities = priorities if priorities is not None else array.array('B', [1]) * n
+
+        # priority -> availability -> pieces with unrequested blocks
+        self._buckets = {}
+        self._pos = array.array('l', [-1]) * n # piece -> its position in its bucket
+        self._partial = set()    # started pieces with unrequested blocks
+        self._requested = {}     # started piece -> bitarray of requested blocks
+        self._received = {}      # started piece -> bitarray of received blocks
+
+        for i in wanted:
+            self._insert(i)
+
+    def add(self, bits):
+        ''' A peer has the pieces in `bits`. '''
+        for i, b in enumerate(bits):
+            if b:
+                self._change(i, +1)
+
+    def remove(self, bits):
+        ''' A peer with the pieces in `bits` is gone. '''
+        for i, b in enumerate(bits):
+            if b:
+                self._change(i, -1)
+
+    def have(self, index):
+        ''' A peer announced it has piece #index. '''
+        self._change(index, +1)
+
+    def pick(self, peer_bits):
+        ''' Return (piece, block) to request from a peer having `peer_bits`,
+            and mark it as requested. Return None if the peer has nothing we need.
+        '''
+        for i in self._partial:
+            if peer_bits[i]:
+                return self._take(i)
+
+        for priority in sorted(self._buckets, reverse=True):
+            for bucket in itertools.islice(self._buckets[priority], 1, None):
+                n = len(bucket)
+                if not n:
+                    continue
+                start = random.randrange(n)
+                for j in xrange(n):
+                    i = bucket[(start + j) % n]
+                    if peer_bits[i]:
+                        return self._take(i)
+
+    def endgame(self):
+        ''' Return True if all the blocks available from connected peers were requested. '''
+        for i in self._partial:
+            if self.availability[i] > 0:
+                return False
+        for buckets in self._buckets.itervalues():
+            for bucket in itertools.islice(buckets, 1, None):
+                if len(bucket):
+                    return False
+        return True
+
+    def release(self, index, block):
+        ''' A requested block will not arrive (e.g. the peer choked us). '''
+        requested = self._requested.get(index)
+        if requested is None or not requested[block] or self._received[index][block]:
+            return # piece was completed or reset meanwhile
+
+        if requested.count() == len(requested):
+            self._insert(index)
+            self._partial.add(index)
+        requested[block] = False
+
+    def received(self, index, block):
+        ''' A requested block has arrived. Return True if the piece is complete. '''
+        received = self._received.get(index)
+        if received is None:
+            return False
+        received[block] = True
+        return received.count() == len(received)
+
+    def complete(self, index):
+        ''' Piece #index was downloaded and verified. '''
+        self._requested.pop(index, None)
+        self._received.pop(index, None)
+        self._partial.discard(index)
+        if self._pos[index] >= 0:
+            self._remove(index)
+
+    def reset(self, index):
+        ''' Piece #index failed verification, so it should be downloaded again. '''
+        log.warning('piece #{} is corrupted'.format(index))
+        self.complete(index)
+        self._insert(index)
+
+    def _take(self, index):
+        requested = self._requested.get(index)
+        if requested is None: # start a new piece
+            n = self.num_blocks(index)
+            requested = self._requested[index] = bitarray.bitarray(n)
+            received = self._received[index] = bitarray.bitarray(n)
+            requested.setall(False)
+            received.setall(False)
+            self._partial.add(index)
+
+        block = int(requested.index(False))
+        requested[block] = True
+        if requested.count() == len(requested):
+            self._partial.discard(index)
+            self._remove(index)
+        return index, block
+
+    def _change(self, index, delta):
+        tracked = self._pos[index] >= 0
+        if tracked:
+            self._remove(index)
+        self.availability[index] += delta
+        if tracked:
+            self._insert(index)
+
+    def _insert(self, index):
+        k = self.availability[index]
+        buckets = self._buckets.setdefault(self.priorities[index], [])
+        while len(buckets) <= k:
+            buckets.append(array.array('i'))
+        bucket = buckets[k]
+        self._pos[index] = len(bucket)
+        bucket.append(index)
+
+    def _remove(self, index):
+        bucket = self._buckets[self.priorities[index]][self.availability[index]]
+        pos = self._pos[index]
+        self._pos[index] = -1
+        last = bucket.pop()
+        if last != index: # move the last piece into the vacant position
+            bucket[pos] = last
+            self._pos[last] = pos
@@ -0,0 +1,142 @@
+import binascii
+import logging
+
+import gevent
+import gevent.lock
+import gevent.server
+
+import peer
+import storage
+import metainfo
+import tracker
+import download
+import connection
+
+log = logging.getLogger('session')
+
+class Download:
+    ''' A torrent in a session: its metadata download, and then its Torrent. '''
+    def __init__(self, info_hash, trackers):
+        self.info_hash = info_hash
+        self.trackers = trackers
+        self.downloader = None # the current download.Metadata or download.Torrent
+        self.greenlet = None
+
+    @property
+    def name(self):
+        return binascii.hexlify(self.info_hash)
+
+    def __repr__(self):
+        return '<Download {} ({})>'.format(self.name, type(self.downloader).__name__)
+
+class Session:
+    ''' Runs many downloads in one process, sharing a listening port (incoming
+        peers are routed by the info hash of their handshake), a tracker
+        client, a disk I/O pool, the global rate limits and a bound on the
+        number of connections of all the downloads.
+    '''
+    def __init__(self, host_id, port=6889, max_connections=500, workers=None,
+                 upload_rate=None, download_rate=None, seed=True, **kw):
+        ''' Rates are in bytes/second (None for unlimited). With `seed`,
+            completed torrents keep uploading until they are removed.
+            Other keyword arguments are passed to each download.Torrent.
+        '''
+        self.host_id = host_id
+        self.port = port
+        self.seed = seed
+        self.kw = kw
+
+        self.client = tracker.Client()
+        self.io = storage.DiskIO(workers)
+        self.limit = connection.Limit(upload=upload_rate, download=download_rate)
+        self.slots = gevent.lock.BoundedSemaphore(max_connections)
+        self.downloads = {} # info hash -> Download
+        self.server = None
+
+    def start(self):
+        ''' Start accepting peers on `port` (0 to pick a free one). '''
+        self.server = gevent.server.StreamServer(('0.0.0.0', self.port), self._accept)
+        self.server.start()
+        self.port = self.server.server_port
+        log.info('listening on port {}'.format(self.port))
+
+    def stop(self):
+        for info_hash in list(self.downloads):
+            self.remove(info_hash)
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+        self.io.kill()
+
+    def add(self, info_hash, trackers, download_data=True):
+        ''' Start downloading the metadata of `info_hash` (unless it is known
+            already) and then, with `download_data`, its data.
+            Return the Download (which may already be in the session).
+        '''
+        if info_hash in self.downloads:
+            return self.downloads[info_hash]
+
+        d = self.downloads[info_hash] = Download(info_hash, trackers)
+        d.greenlet = gevent.spawn(self._run, d, download_data)
+        log.info('added {}'.format(d.name))
+        return d
+
+    def add_magnet(self, link, **kw):
+        m = metainfo.parse_magnet(link)
+        return self.add(m['info_hash'], m['trackers'], **kw)
+
+    def remove(self, info_hash):
+        ''' Stop a download, closing its connections and its files. '''
+        d = self.downloads.pop(info_hash, None)
+        if d is None:
+            return
+        d.greenlet.kill()
+        log.info('removed {}'.format(d.name))
+
+    def join(self, timeout=None):
+        ''' Wait until all the downloads are done (or removed). '''
+        gevent.joinall([d.greenlet for d in self.downloads.values()], timeout=timeout)
+
+    def _shared(self):
+        return dict(client=self.client, port=self.port, global_limit=self.limit, slots=self.slots)
+
+    def _run(self, d, download_data):
+        meta = download.metadata_load(d.info_hash)
+        if meta is None:
+            d.downloader = download.Metadata(self.host_id, d.info_hash, **self._shared())
+            meta = d.downloader.run(d.trackers)
+
+        if not download_data:
+            return meta
+
+        d.downloader = None # until the data is checked
+        kw = dict(self.kw, io=self.io, listen=False, **self._shared())
+        t = d.downloader = download.Torrent(self.host_id, meta, **kw)
+        try:
+            if not t.done():
+                t.run(d.trackers)
+            log.info('{} completed'.format(d.name))
+            if self.seed:
+                t.run(d.trackers) # until removed
+        finally:
+            d.downloader = None # route no more peers to it
+            t.data.close() # save fast-resume data
+        return meta
+
+    def _accept(self, sock, addr):
+        ''' Route an incoming connection by the info hash of its handshake. '''
+        stream = connection.Stream(addr, timeout=60, sock=sock)
+        try:
+            msg = stream.peek(peer.HANDSHAKE_SIZE)
+            info_hash = peer.parse_handshake(msg).info_hash
+        except (connection.Closed, peer.ParseError), e:
+            log.warning('{} at {}'.format(e, addr))
+            stream.close()
+            return
+
+        d = self.downloads.get(info_hash)
+        if d is None or d.downloader is None:
+            log.info('{} asked for unknown torrent {}'.format(addr, binascii.hexlify(info_hash)))
+            stream.close()
+            return
+        d.downloader.accept(stream, addr)
@@ -1,16 +1,30 @@
 import os
 import math
+import bisect
+import array
+import mmap
+import time
 import binascii
+import threading
+import ctypes
+import ctypes.util
 import logging
+import collections
+import multiprocessing
 
 import bitarray
+import gevent.lock
+import gevent.threadpool
 
+import bencode
 import metainfo
 
 def bitfield(data, n):
     bits = bitarray.bitarray(endian='big')
     if data is not None:
         bits.frombytes(data)
+    else:
+        bits.extend([False] * n)
     assert not any(bits[n:])
     del bits[n:]
     return bits
@@ -18,46 +32,320 @@ def bitfield(data, n):
 def indices(bits):
     return [i for i, b in enumerate(bits) if b]
 
+def _mtime(st):
+    return int(round(st.st_mtime * 1e6)) # in microseconds, as bencode has no floats
+
 log = logging.getLogger('storage')
 
+# posix_fallocate() is not exposed by Python 2's os module
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _posix_fallocate = _libc.posix_fallocate
+    _posix_fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError, TypeError):
+    _posix_fallocate = None
+
+def fill(fd, total, allocation):
+    ''' Resize the file to `total` bytes, preallocating it as specified by
+        `allocation`: 'sparse' (only set its size), 'full' (reserve disk space
+        using posix_fallocate, where available) or 'zero' (write zeros).
+    '''
+    fd.seek(0, 2) # seek to EOF
+    size = fd.tell()
+    if size < total:
+        _allocators[allocation](fd, size, total)
+    if size > total:
+        fd.truncate(total)
+
+def _allocate_sparse(fd, size, total):
+    fd.truncate(total)
+
+def _allocate_full(fd, size, total):
+    if _posix_fallocate is None:
+        log.warning('posix_fallocate() is unavailable, writing zeros')
+        return _allocate_zero(fd, size, total)
+
+    fd.flush()
+    err = _posix_fallocate(fd.fileno(), size, total - size)
+    if err:
+        raise IOError(err, os.strerror(err))
+
+def _allocate_zero(fd, size, total):
+    left = total - size # bytes left to fill
+    buff = '\x00' * 1024
+    while left > 0:
+        buff = buff[:left]
+        fd.write(buff)
+        left = left - len(buff)
+
+_allocators = {
+    'sparse': _allocate_sparse,
+    'full': _allocate_full,
+    'zero': _allocate_zero,
+}
+
+def piece_priorities(meta, priorities=None):
+    ''' Return the priority of each piece: the highest of the files it overlaps.
+        `priorities` are per-file, where 0 means the file should be skipped.
+    '''
+    if priorities is None:
+        priorities = [1] * len(meta.files)
+    assert len(priorities) == len(meta.files)
+
+    result = array.array('B', [0]) * len(meta.hashes)
+    offset = 0
+    for (path, length), priority in zip(meta.files, priorities):
+        first = offset // meta.piece_length
+        last = (offset + max(length, 1) - 1) // meta.piece_length
+        for i in xrange(first, min(last + 1, len(result))):
+            result[i] = max(result[i], priority)
+        offset = offset + length
+    return result
+
+class DiskIO:
+    ''' Runs disk jobs (reads, writes and hashing) in a bounded thread pool,
+        so that a slow disk stalls only the greenlets waiting for it, and not
+        the gevent hub. hashlib releases the GIL, so hashing also runs in parallel.
+
+    Submitting waits while `max_pending` jobs are already pending. `pending`,
+    `max_depth` and `stalls` (submissions which had to wait) show whether the
+    disk is the bottleneck.
+    '''
+    def __init__(self, workers=None, max_pending=2**8):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool = gevent.threadpool.ThreadPool(self.workers)
+        self._slots = gevent.lock.BoundedSemaphore(max_pending)
+
+        self.pending = 0    # submitted jobs, which were not completed yet
+        self.max_depth = 0  # highest number of pending jobs
+        self.stalls = 0
+        self.completed = 0
+
+    def submit(self, func, *args):
+        ''' Queue func(*args) to run in a worker thread, returning its AsyncResult. '''
+        if self._slots.locked():
+            self.stalls = self.stalls + 1
+            log.debug('disk queue is full ({} jobs)'.format(self.pending))
+        self._slots.acquire()
+        self.pending = self.pending + 1
+        self.max_depth = max(self.max_depth, self.pending)
+        result = self.pool.spawn(func, *args)
+        result.rawlink(self._done)
+        return result
+
+    def run(self, func, *args):
+        ''' Run func(*args) in a worker thread, and wait for its result. '''
+        return self.submit(func, *args).get()
+
+    def _done(self, result):
+        self.pending = self.pending - 1
+        self.completed = self.completed + 1
+        self._slots.release()
+
+    def kill(self):
+        self.pool.kill()
+
+    def __repr__(self):
+        return '<DiskIO {} pending (max {}), {} completed, {} stalls>'.format(
+            self.pending, self.max_depth, self.completed, self.stalls)
+
 class Data:
+    ''' Stores the torrent's data in a single <infohash>.tmp file.
+
+    read() and write() block on the disk, so other greenlets should call
+    them through the disk I/O pool (`io`), where they run in worker threads.
+    '''
 
-    def __init__(self, meta):
+    batch_size = 2**22 # bytes to read and hash per validation job
+    resume_interval = 60 # seconds between fast-resume file updates
+
+    def __init__(self, meta, workers=None, allocation='sparse', priorities=None, io=None):
+        ''' `allocation` is how new files are preallocated (see fill()).
+            `priorities` are per-file, and only used by backends which lay
+            out the files separately (skipped files are not allocated).
+            `io` is a DiskIO, which may be shared by several torrents
+            (by default, one with `workers` threads is created).
+        '''
         h = binascii.hexlify(meta.info_hash)
         fname = '{}.tmp'.format(h)
         self.meta = meta
-        mode = ('r' if os.path.exists(fname) else 'w') + 'b+'
-        self.fd = file(fname, mode)
-        self._fill()
+        self.fname = fname
+        self.resume_fname = '{}.resume'.format(h)
+        self.priorities = priorities or [1] * len(meta.files)
         self.bits = bitarray.bitarray([0]*len(self.meta.hashes), endian='big')
-        self.validate()
-
-    def _fill(self):
-        self.fd.seek(0, 2) # seek to EOF
-        left = self.meta.total - self.fd.tell() # bytes left to fill
-        buff = '\x00' * 1024
-        while left > 0:
-            buff = buff[:left]
-            self.fd.write(buff)
-            left = left - len(buff)
-        self.fd.seek(self.meta.total)
-        self.fd.truncate()
-
-    def validate(self, index_list=None):
+        self.lock = threading.Lock() # for file positions, used by worker threads
+
+        # must be checked before the file is opened for writing
+        resumed = self._load_resume()
+
+        created = self._open(allocation)
+
+        self._own_io = io is None
+        self.io = DiskIO(workers) if io is None else io
+        self._resume_saved = time.time()
+        if created:
+            log.info('created {} ({} allocation)'.format(fname, allocation))
+        elif not resumed:
+            self.validate()
+        if not resumed:
+            self.save_resume()
+
+    def _load_resume(self):
+        ''' Use the bitfield from the fast-resume file, if the data file
+            was not modified since it was written.
+        '''
+        try:
+            with file(self.resume_fname, 'rb') as f:
+                state = bencode.decode(f.read())
+            size, mtime = self._file_state()
+            bits = bitfield(state['bits'], n=len(self.bits))
+            if bits.length() != len(self.bits):
+                raise ValueError('bitfield has {} bits'.format(bits.length()))
+            if (state['size'], state['mtime']) != (size, mtime):
+                log.info('{} was modified, checking all pieces'.format(self.fname))
+                return False
+        except EnvironmentError as e:
+            log.info('no fast-resume data: {}'.format(e))
+            return False
+        except (bencode.Error, KeyError, TypeError, ValueError, AssertionError) as e:
+            log.warning('invalid fast-resume data: {!r}'.format(e))
+            return False
+
+        self.bits = bits
+        log.info('resumed: host has {} of {} pieces'.format(self.bits.count(), len(self.bits)))
+        return True
+
+    def save_resume(self):
+        ''' Write the verified bitfield, with the data file size and mtime. '''
+        self.io.run(self._save_resume, self.bits.tobytes())
+        self._resume_saved = time.time()
+        log.debug('saved fast-resume data to {}'.format(self.resume_fname))
+
+    def _save_resume(self, bits):
+        ''' Flush the data, and write the fast-resume file (in a worker thread). '''
+        self.flush()
+        size, mtime = self._file_state()
+        state = collections.OrderedDict([('bits', bits), ('mtime', mtime), ('size', size)])
+        tmp = self.resume_fname + '.part'
+        with file(tmp, 'wb') as f:
+            f.write(bencode.encode(state))
+        os.rename(tmp, self.resume_fname) # replace atomically
+
+    def flush(self):
+        ''' Blocks on the disk (and on writes in progress): call it through `io`. '''
+        with self.lock:
+            self.fd.flush()
+
+    def close(self):
+        self.save_resume()
+        self._close_files()
+        if self._own_io:
+            self.io.kill()
+
+    def _close_files(self):
+        self.fd.close()
+
+    def _open(self, allocation):
+        ''' Open (and preallocate) the data file, returning whether it was created. '''
+        created = not os.path.exists(self.fname)
+        mode = ('w' if created else 'r') + 'b+'
+        self.fd = file(self.fname, mode)
+        fill(self.fd, self.meta.total, allocation)
+        return created
+
+    def _file_state(self):
+        ''' Return the size and mtime of the data, as kept in the fast-resume file. '''
+        st = os.stat(self.fname)
+        return st.st_size, _mtime(st)
+
+    def validate(self, index_list=None, progress=None):
+        ''' Hash the given pieces (by default, all the missing ones) in the
+            thread pool, and return how many of them are valid.
+            `progress(done, total)` is called as batches of pieces are hashed.
+        '''
         if index_list is None:
             index_list = indices(~self.bits)
 
-        for i in index_list:
-            data = self.read(i)
-            h = metainfo.hash(data)
-            success = (self.meta.hashes[i] == h)
-            self.bits[i] = success
-            if success:
-                log.debug('validated piece #{} ({} of {})'.format(i, self.bits.count(), len(self.bits)))
+        self.io.run(self.flush) # pieces are read by worker threads, using their own file objects
+
+        total = len(index_list)
+        done = 0
+        jobs = collections.deque() # keep a bounded number of batches in memory
+        batches = self._batches(index_list)
+        while True:
+            for batch in batches:
+                jobs.append(self.io.submit(self._hash_batch, batch))
+                if len(jobs) >= 2 * self.io.workers:
+                    break
+
+            if not jobs:
+                break
+
+            prev = done
+            for i, success in jobs.popleft().get():
+                self.bits[i] = success
+                if success:
+                    log.debug('validated piece #{} ({} of {})'.format(i, self.bits.count(), len(self.bits)))
+                done = done + 1
+
+            if total > 1 and 10 * done // total > 10 * prev // total: # every 10%
+                log.info('checked {} of {} pieces'.format(done, total))
+            if progress is not None:
+                progress(done, total)
 
         log.info('host has {} of {} pieces'.format(self.bits.count(), len(self.bits)))
+        self._update_resume()
         return sum(self.bits[i] for i in index_list)
 
+    def commit(self, index, data):
+        ''' Hash a complete piece from memory, and write it only if it is valid. '''
+        assert len(data) == self.piece_size(index)
+        success = self.io.run(self._commit, index, data)
+        if success:
+            self.bits[index] = True
+            log.debug('validated piece #{} ({} of {})'.format(index, self.bits.count(), len(self.bits)))
+            self._update_resume()
+        return success
+
+    def _commit(self, index, data):
+        ''' Hash a piece, and write it if it is valid (in a worker thread). '''
+        if self.meta.hashes[index] != metainfo.hash(data):
+            return False
+        self.write(index, 0, data)
+        return True
+
+    def _update_resume(self):
+        if time.time() - self._resume_saved > self.resume_interval:
+            self.save_resume()
+
+    def _batches(self, index_list):
+        ''' Split into runs of consecutive pieces, of up to batch_size bytes. '''
+        batch = []
+        for i in index_list:
+            if batch and (i != batch[-1] + 1 or
+                          len(batch) * self.meta.piece_length >= self.batch_size):
+                yield batch
+                batch = []
+            batch.append(i)
+        if batch:
+            yield batch
+
+    def _hash_batch(self, batch):
+        ''' Read a run of consecutive pieces and hash them (in a worker thread). '''
+        first = batch[0]
+        offset = first * self.meta.piece_length
+        size = sum(self.piece_size(i) for i in batch)
+        with file(self.fname, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size)
+
+        results = []
+        for i in batch:
+            begin = (i - first) * self.meta.piece_length
+            h = metainfo.hash(buffer(data, begin, self.piece_size(i)))
+            results.append((i, self.meta.hashes[i] == h))
+        return results
+
     def piece_size(self, index):
         n = len(self.bits)
         if index < 0 or index >= n:
@@ -75,8 +363,9 @@ class Data:
         assert size >= 0
         assert begin + size <= self.piece_size(index)
 
-        self.fd.seek(index * self.meta.piece_length + begin)
-        data = self.fd.read(size)
+        with self.lock:
+            self.fd.seek(index * self.meta.piece_length + begin)
+            data = self.fd.read(size)
         assert len(data) == size
         return data
 
@@ -84,6 +373,388 @@ class Data:
         assert begin >= 0
         assert begin + len(data) <= self.piece_size(index)
 
-        self.fd.seek(index * self.meta.piece_length + begin)
-        self.fd.write(data)
+        with self.lock:
+            self.fd.seek(index * self.meta.piece_length + begin)
+            self.fd.write(data)
+
+class MappedData(Data):
+    ''' Data backend which memory-maps the data file.
+        Reads return zero-copy buffers into the mapping (which can be sent to
+        a socket as-is), and writes copy directly into it.
+    '''
+    def _open(self, allocation):
+        created = Data._open(self, allocation)
+        self.fd.flush()
+        self.map = mmap.mmap(self.fd.fileno(), self.meta.total)
+        return created
+
+    def _hash_batch(self, batch):
+        results = []
+        for i in batch:
+            data = buffer(self.map, i * self.meta.piece_length, self.piece_size(i))
+            results.append((i, self.meta.hashes[i] == metainfo.hash(data)))
+        return results
+
+    def flush(self):
+        self.map.flush()
+
+    def _close_files(self):
+        self.map.close()
+        self.fd.close()
+
+    def read(self, index, begin=0, size=None):
+        if size is None:
+            size = self.piece_size(index) # read all piece
+
+        assert begin >= 0
+        assert size >= 0
+        assert begin + size <= self.piece_size(index)
+
+        return buffer(self.map, index * self.meta.piece_length + begin, size)
+
+    def write(self, index, begin, data):
+        assert begin >= 0
+        assert begin + len(data) <= self.piece_size(index)
+
+        # mmap.write() accepts any read-only buffer, unlike slice assignment
+        with self.lock:
+            self.map.seek(index * self.meta.piece_length + begin)
+            self.map.write(buffer(data))
+
+class FilesData(Data):
+    ''' Data backend which lays out the torrent's files under their own names
+        (relative to the current directory), mapping piece ranges onto them.
+
+    Files with priority 0 are skipped: they are not allocated, and only
+    the bytes of pieces which they share with wanted files are written to
+    them (so these files are created sparsely, if at all).
+    '''
+    def __init__(self, meta, **kw):
+        self.layout = [] # (path, offset, length) of each file
+        offset = 0
+        for path, length in meta.files:
+            self.layout.append((os.path.join(*path), offset, length))
+            offset = offset + length
+        self._offsets = [start for _, start, _ in self.layout]
+        self.fds = {} # file index -> open file object
+        Data.__init__(self, meta, **kw)
+
+    def _open(self, allocation):
+        created = not any(os.path.exists(path) for path, _, _ in self.layout)
+        for k, (path, _, length) in enumerate(self.layout):
+            if self.priorities[k] > 0:
+                fill(self._fd(k, create=True), length, allocation)
+        return created
+
+    def _fd(self, k, create=False):
+        fd = self.fds.get(k)
+        if fd is None:
+            fd = self._open_file(k, create=create, mode='r+b')
+            if fd is not None:
+                self.fds[k] = fd
+        return fd
+
+    def _open_file(self, k, create=False, mode='rb'):
+        path = self.layout[k][0]
+        if os.path.exists(path):
+            return file(path, mode)
+        if not create:
+            return None
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        return file(path, 'w+b')
+
+    def _spans(self, offset, size):
+        ''' Yield (file index, offset in file, size) covering the given range. '''
+        k = bisect.bisect_right(self._offsets, offset) - 1
+        while size > 0 and k < len(self.layout):
+            path, start, length = self.layout[k]
+            if offset < start + length: # skip empty files
+                n = min(size, start + length - offset)
+                yield k, offset - start, n
+                offset = offset + n
+                size = size - n
+            k = k + 1
+
+    def _read_range(self, offset, size, get_fd):
+        chunks = []
+        for k, file_offset, n in self._spans(offset, size):
+            fd = get_fd(k)
+            if fd is None: # skipped file, which was never written
+                chunks.append('\x00' * n)
+                continue
+            fd.seek(file_offset)
+            data = fd.read(n)
+            chunks.append(data + '\x00' * (n - len(data)))
+        return ''.join(chunks)
+
+    def _file_state(self):
+        stats = [os.stat(path) for path, _, _ in self.layout if os.path.exists(path)]
+        if not stats:
+            return 0, 0
+        return sum(st.st_size for st in stats), max(_mtime(st) for st in stats)
+
+    def _hash_batch(self, batch):
+        ''' Read a run of consecutive pieces and hash them (in a worker thread). '''
+        fds = {}
+        def get_fd(k): # worker threads use their own file objects
+            if k not in fds:
+                fds[k] = self._open_file(k)
+            return fds[k]
+
+        first = batch[0]
+        size = sum(self.piece_size(i) for i in batch)
+        try:
+            data = self._read_range(first * self.meta.piece_length, size, get_fd)
+        finally:
+            for fd in fds.values():
+                if fd is not None:
+                    fd.close()
+
+        results = []
+        for i in batch:
+            begin = (i - first) * self.meta.piece_length
+            h = metainfo.hash(buffer(data, begin, self.piece_size(i)))
+            results.append((i, self.meta.hashes[i] == h))
+        return results
+
+    def flush(self):
+        with self.lock:
+            for fd in self.fds.values():
+                fd.flush()
+
+    def _close_files(self):
+        for fd in self.fds.values():
+            fd.close()
+
+    def read(self, index, begin=0, size=None):
+        if size is None:
+            size = self.piece_size(index) # read all piece
+
+        assert begin >= 0
+        assert size >= 0
+        assert begin + size <= self.piece_size(index)
+
+        with self.lock:
+            return self._read_range(index * self.meta.piece_length + begin, size, self._fd)
+
+    def write(self, index, begin, data):
+        assert begin >= 0
+        assert begin + len(data) <= self.piece_size(index)
+
+        pos = 0
+        with self.lock:
+            for k, file_offset, n in self._spans(index * self.meta.piece_length + begin, len(data)):
+                fd = self._fd(k, create=True)
+                fd.seek(file_offset)
+                fd.write(buffer(data, pos, n))
+                pos = pos + n
+
+# storage backends, by name
+backends = {'file': Data, 'mmap': MappedData, 'files': FilesData}
+
+
+class PieceBuffer:
+    ''' Assembles downloaded blocks in memory, so that each piece is hashed
+        before it is written, and is written to disk in a single call.
+
+    If more than `max_size` bytes are buffered, the oldest pieces are spilled:
+    what they have is written to disk, and so are their following blocks.
+    These are validated by reading them back from disk, as usual.
+    A spill writes the whole piece (zeros for the missing blocks), so the
+    following blocks and the validation wait until it is done.
+    '''
+    def __init__(self, data, max_size):
+        self.data = data
+        self.max_size = max_size
+        self.size = 0
+        self.pieces = collections.OrderedDict() # index -> bytearray, oldest first
+        self.spilled = {} # index -> AsyncResult of writing its buffer
+
+    def write(self, index, begin, data):
+        spill = self.spilled.get(index)
+        if spill is not None:
+            spill.get()
+            self.data.io.run(self.data.write, index, begin, data)
+            return
+
+        buf = self.pieces.get(index)
+        if buf is None:
+            buf = self.pieces[index] = bytearray(self.data.piece_size(index))
+            self.size = self.size + len(buf)
+        buf[begin:begin+len(data)] = data
+
+        while self.size > self.max_size:
+            i, buf = self.pieces.popitem(last=False)
+            self.size = self.size - len(buf)
+            log.debug('spilling piece #{} to disk'.format(i))
+            self.spilled[i] = self.data.io.submit(self.data.write, i, 0, buf)
+            self.spilled[i].get()
+
+    def validate(self, index):
+        ''' All blocks of the piece were written: return whether it is valid. '''
+        buf = self.pieces.pop(index, None)
+        if buf is None:
+            spill = self.spilled.pop(index, None)
+            if spill is not None:
+                spill.get()
+            return self.data.validate([index]) > 0
+
+        self.size = self.size - len(buf)
+        return self.data.commit(index, buf)
+
+class ReadCache:
+    ''' LRU cache of whole pieces, for serving block requests from peers.
+        The first request for a block reads its whole piece, so that requests
+        for neighbouring blocks (from any peer) are served from memory.
+    '''
+    def __init__(self, data, max_size):
+        self.data = data
+        self.max_size = max_size
+        self.size = 0
+        self.pieces = collections.OrderedDict() # index -> data, least recently used first
+        self.reading = {} # index -> AsyncResult of reading a piece which missed
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def read(self, index, begin, size):
+        assert self.data.bits[index] # only valid pieces are cached
+        piece = self.pieces.pop(index, None)
+        if piece is not None:
+            self.hits = self.hits + 1
+            self.pieces[index] = piece # mark as most recently used
+        elif index in self.reading: # another peer missed it, and is reading it
+            self.hits = self.hits + 1
+            piece = self.reading[index].get()
+        else:
+            self.misses = self.misses + 1
+            piece = self._load(index)
+
+        assert begin >= 0
+        assert begin + size <= len(piece)
+        return buffer(piece, begin, size)
+
+    def _load(self, index):
+        result = self.reading[index] = self.data.io.submit(self.data.read, index)
+        try:
+            piece = result.get()
+        finally:
+            del self.reading[index]
+
+        self.size = self.size + len(piece)
+        while self.pieces and self.size > self.max_size:
+            _, evicted = self.pieces.popitem(last=False)
+            self.size = self.size - len(evicted)
+            self.evictions = self.evictions + 1
+        self.pieces[index] = piece
+        return piece
+
+    def __repr__(self):
+        return '<ReadCache {:.1f}MB: {} hits, {} misses, {} evictions>'.format(
+            self.size / 1e6, self.hits, self.misses, self.evictions)
+
+## Unittests
+def test(backend):
+    import shutil
+    import tempfile
+    import gevent.pool
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        piece_length = 2**16
+        content = os.urandom(5 * piece_length + 1234)
+        pieces = [content[i:i+piece_length] for i in range(0, len(content), piece_length)]
+        info = collections.OrderedDict([('length', len(content)), ('name', 'test'),
+            ('piece length', piece_length), ('pieces', ''.join(metainfo.hash(p) for p in pieces))])
+        meta = metainfo.MetaInfo(info)
+
+        data = backend(meta, workers=2)
+        assert data.bits.count() == 0
+        buf = PieceBuffer(data, max_size=2 * piece_length)
+        for i in [0, 1, 2, 3, 4, 5]:
+            piece = pieces[i] if i != 3 else 'x' * piece_length # corrupt piece #3
+            for begin in range(0, len(piece), 2**14):
+                buf.write(i, begin, buffer(piece, begin, 2**14))
+        assert [buf.validate(i) for i in range(6)] == [True] * 3 + [False] + [True] * 2
+        assert data.bits.to01() == '111011'
+
+        # blocks written while their piece is being spilled land after the spill
+        data.bits[1] = data.bits[2] = False
+        buf = PieceBuffer(data, max_size=piece_length)
+        blocks = [(i, begin) for begin in range(0, piece_length, 2**14) for i in [1, 2]]
+        gevent.pool.Group().map(lambda (i, begin): buf.write(i, begin, pieces[i][begin:begin+2**14]), blocks)
+        assert [buf.validate(i) for i in [1, 2]] == [True, True]
+
+        cache = ReadCache(data, max_size=piece_length)
+        assert str(cache.read(5, 10, 20)) == pieces[5][10:30]
+        assert str(cache.read(0, 0, 100)) == pieces[0][:100]
+        assert (cache.hits, cache.misses, cache.evictions) == (0, 2, 1)
+
+        # peers missing on the same piece at once share a single read
+        reads = gevent.pool.Group().map(lambda begin: str(cache.read(4, begin, 10)), [0, 10, 20])
+        assert reads == [pieces[4][begin:begin+10] for begin in [0, 10, 20]]
+        assert (cache.hits, cache.misses, cache.size) == (2, 3, piece_length)
+        data.close()
+
+        data = backend(meta) # resumed, without hashing
+        assert data.bits.to01() == '111011'
+        data.write(3, 0, pieces[3])
+        assert data.validate([3]) == 1
+        assert str(data.read(3)) == pieces[3]
+        data.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+def test_files():
+    import shutil
+    import tempfile
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        piece_length = 2**14
+        sizes = [3 * piece_length // 2, 0, piece_length, 2 * piece_length + 5]
+        content = os.urandom(sum(sizes))
+        pieces = [content[i:i+piece_length] for i in range(0, len(content), piece_length)]
+        files = [collections.OrderedDict([('length', n), ('path', ['dir', str(k)])])
+                 for k, n in enumerate(sizes)]
+        info = collections.OrderedDict([('files', files), ('name', 'test'),
+            ('piece length', piece_length), ('pieces', ''.join(metainfo.hash(p) for p in pieces))])
+        meta = metainfo.MetaInfo(info)
+
+        priorities = [1, 1, 0, 2] # skip file #2
+        assert piece_priorities(meta, priorities).tolist() == [1, 1, 2, 2, 2]
+
+        data = FilesData(meta, priorities=priorities)
+        assert os.path.getsize('test/dir/3') == sizes[3]
+        assert not os.path.exists('test/dir/2') # not allocated
+        data.write(3, 0, pieces[3])
+        assert data.validate() == 1
+        assert not os.path.exists('test/dir/2')
+        for i in [0, 1, 2, 4]: # pieces #1 and #2 are shared with file #2
+            data.write(i, 0, pieces[i])
+        assert data.validate() == 4
+        assert [os.path.getsize('test/dir/{}'.format(k)) for k in range(4)] == sizes
+        assert ''.join(open('test/dir/{}'.format(k)).read() for k in range(4)) == content
+        assert data.read(1, 10, piece_length - 10) == pieces[1][10:]
+        data.close()
+
+        data = FilesData(meta, priorities=priorities) # resumed
+        assert data.bits.all()
+        data.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
 
+if __name__ == '__main__':
+    for name, backend in sorted(backends.items()):
+        print 'testing {} backend'.format(name)
+        test(backend)
+    print 'testing multi-file layout'
+    test_files()
@@ -0,0 +1,105 @@
+import time
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger('swarm')
+
+class Swarm:
+    ''' Candidate peer addresses (e.g. from trackers), and which one to connect next.
+
+    An address is "active" from next() until disconnected(). If it was not
+    connected() meanwhile, the attempt failed, and the address is retried
+    after an exponential backoff, until it fails `max_failures` times in a
+    row. Peers which disconnect after a successful handshake are retried
+    after `backoff` seconds.
+    '''
+    def __init__(self, backoff=30, max_backoff=3600, max_failures=5):
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_failures = max_failures
+
+        self.candidates = OrderedDict() # address -> [failures, retry time]
+        self.active = set()
+        self.established = set() # active addresses, which completed the handshake
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def add(self, addr):
+        ''' Return True if `addr` is a new candidate. '''
+        if addr in self.candidates:
+            return False
+        self.candidates[addr] = [0, 0]
+        return True
+
+    def next(self, now=None):
+        ''' Return the next address to connect to, or None if none is ready. '''
+        now = time.time() if now is None else now
+        for addr, (failures, retry) in self.candidates.iteritems():
+            if retry <= now and addr not in self.active:
+                self.active.add(addr)
+                return addr
+
+    def wait_time(self, now=None):
+        ''' Return the time until some idle address is ready, or None if there are none. '''
+        now = time.time() if now is None else now
+        retries = [retry for addr, (failures, retry) in self.candidates.iteritems()
+                   if addr not in self.active]
+        if retries:
+            return max(min(retries) - now, 0)
+
+    def connected(self, addr):
+        self.established.add(addr)
+
+    def disconnected(self, addr, now=None):
+        now = time.time() if now is None else now
+        self.active.discard(addr)
+        state = self.candidates[addr]
+        if addr in self.established:
+            self.established.discard(addr)
+            state[:] = [0, now + self.backoff]
+            return
+
+        state[0] += 1
+        if state[0] >= self.max_failures:
+            log.debug('giving up on {} after {} failures'.format(addr, state[0]))
+            del self.candidates[addr]
+            return
+        state[1] = now + min(self.backoff * 2**(state[0] - 1), self.max_backoff)
+
+## Unittests
+
+def test():
+    s = Swarm(backoff=10, max_backoff=30, max_failures=4)
+    assert s.add('a') and s.add('b') and not s.add('a')
+    assert s.wait_time(now=0) == 0
+
+    assert s.next(now=0) == 'a'
+    assert s.next(now=0) == 'b'
+    assert s.next(now=0) is None
+    assert s.wait_time(now=0) is None # all are active
+
+    s.connected('a')
+    s.disconnected('a', now=0) # a normal disconnection
+    s.disconnected('b', now=0) # a failure
+    assert s.candidates['a'] == [0, 10]
+    assert s.candidates['b'] == [1, 10]
+    assert s.next(now=5) is None and s.wait_time(now=5) == 5
+
+    # failures back off exponentially, up to max_backoff
+    for now, delay in ((100, 20), (200, 30)):
+        assert s.next(now=now) == 'a'
+        assert s.next(now=now) == 'b'
+        s.connected('a')
+        s.disconnected('a', now=now)
+        s.disconnected('b', now=now)
+        assert s.candidates['b'][1] == now + delay
+    assert s.candidates['a'] == [0, 210]
+
+    assert s.next(now=300) == 'a'
+    assert s.next(now=300) == 'b'
+    s.disconnected('b', now=300)
+    assert 'b' not in s.candidates and len(s) == 1
+
+if __name__ == '__main__':
+    test()
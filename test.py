@@ -1,7 +1,7 @@
 import logging
 
 import metainfo
-import download
+import session
 
 log = logging.getLogger('main')
 
@@ -12,27 +12,42 @@ def main(args):
 
     host_id = metainfo.hash(args.host)
 
-    m = metainfo.parse_magnet(args.link)
-    meta = download.metadata_load(m['info_hash'])
-
-    if args.metadata:
-        if meta is None:
-            dl = download.Metadata(host_id, m['info_hash'])
-            meta = dl.run(m['trackers'])
-
-    if args.torrent and meta:
-        dl = download.Torrent(host_id, meta)
-        if not all(dl.data.bits):
-            dl.run(m['trackers'])
+    if not (args.metadata or args.torrent):
+        return
+
+    priorities = None
+    if args.priorities:
+        priorities = [int(p) for p in args.priorities.split(',')]
+    s = session.Session(host_id, port=args.port, seed=args.seed,
+                        upload_rate=args.upload_rate * 1e3 or None,
+                        download_rate=args.download_rate * 1e3 or None,
+                        allocation=args.allocation, backend=args.storage,
+                        priorities=priorities)
+    s.start()
+    try:
+        for link in args.link:
+            s.add_magnet(link, download_data=args.torrent)
+        s.join() # until stopped, when seeding
         log.info('Download completed')
+    finally:
+        s.stop() # save fast-resume data
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description='Simple Python BitTorrent Client')
     parser.add_argument('--host', default='none')
-    parser.add_argument('--link', default='')
+    parser.add_argument('--link', action='append', default=[],
+        help='magnet link (may be given several times)')
     parser.add_argument('--metadata', action='store_true', default=False)
     parser.add_argument('--torrent', action='store_true', default=False)
+    parser.add_argument('--allocation', choices=['sparse', 'full', 'zero'], default='sparse')
+    parser.add_argument('--storage', choices=['file', 'mmap', 'files'], default='file')
+    parser.add_argument('--priorities', default='',
+        help='comma-separated priority per file (0 to skip)')
+    parser.add_argument('--port', type=int, default=6889)
+    parser.add_argument('--seed', action='store_true', default=False)
+    parser.add_argument('--upload-rate', type=int, default=0, help='kB/s (0 for unlimited)')
+    parser.add_argument('--download-rate', type=int, default=0, help='kB/s (0 for unlimited)')
     args = parser.parse_args()
 
     try:
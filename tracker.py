@@ -1,15 +1,23 @@
 import re
+import time
 import random
 import struct
 import cStringIO
 import binascii
 import logging
+import urlparse
+import collections
+from collections import OrderedDict, namedtuple
 
 import hashlib
 import metainfo
 import bencode
 
 import construct as c
+import gevent
+import gevent.event
+import gevent.queue
+import gevent.server
 from gevent import socket
 
 class Error(Exception):
@@ -21,6 +29,18 @@ log = logging.getLogger('tracker')
 
 INIT_ID = 0x41727101980
 
+# actions
+CONNECT, ANNOUNCE, SCRAPE, ERROR = range(4)
+
+CONNECTION_ID_TTL = 60 # seconds
+RETRANSMIT_TIMEOUT = 15 # seconds, doubled on each retransmission
+MAX_RETRANSMITS = 8
+MAX_SCRAPE_HASHES = 74 # per packet, the most that trackers are expected to answer
+MAX_SCRAPE_PACKETS = 8 # in flight
+
+_header = struct.Struct('>II') # action, transaction_id
+_request_header = struct.Struct('>QII') # connection_id, action, transaction_id
+
 connect_req = c.Struct('request', 
     c.UBInt64('connection_id'),
     c.UBInt32('action'),
@@ -55,7 +75,7 @@ announce_resp = c.Struct('response',
     c.UBInt32('interval'),
     c.UBInt32('leechers'),
     c.UBInt32('seeders'),
-    c.GreedyRange(
+    c.OptionalGreedyRange(
         c.Struct('peer',
             c.Array(4, c.UBInt8('addr')),
             c.UBInt16('port')
@@ -86,46 +106,59 @@ scrape_resp = c.Struct('response',
     )
 )
 
+Stats = namedtuple('Stats', 'seeders completed leechers')
+
 class udp:
-    def __init__(self, addr, timeout=None):
+    ''' UDP tracker connection (BEP 15).
+
+    The connection ID is reused while it is valid, and requests are
+    retransmitted after 15 * 2**n seconds (n = 0..8) until answered.
+    A single reader dispatches the responses by their transaction ID, so
+    several exchanges (e.g. for different torrents) may run at once.
+    '''
+    def __init__(self, addr, timeout=RETRANSMIT_TIMEOUT, retries=MAX_RETRANSMITS):
         self.conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.conn.settimeout(timeout)
         self.conn.connect(addr)
         log.debug('connected to {}'.format(self.conn.getpeername()))
         self.addr = addr
+        self.timeout = timeout
+        self.retries = retries
+        self.waiting = {} # transaction ID -> AsyncResult of its response
+        self.reader = None
         self.id = None
+        self.id_time = None
+
+        # statistics from the last announce
+        self.interval = None
+        self.seeders = None
+        self.leechers = None
 
     def connect(self):
-        tx = random.getrandbits(32)
-        obj = c.Container(connection_id=INIT_ID, action=0, transaction_id=tx)
-        msg = connect_req.build(obj)
+        ''' Get a new connection ID, unless the current one is still valid. '''
+        if self.id is not None and time.time() - self.id_time < CONNECTION_ID_TTL:
+            return
 
+        tx = random.getrandbits(32)
+        obj = c.Container(connection_id=INIT_ID, action=CONNECT, transaction_id=tx)
         log.debug('transaction: {}'.format(tx))
-        self.conn.send(msg)
+        responses = self._exchange({tx: connect_req.build(obj)})
 
-        # handle response
-        msg = self.conn.recv(MAX_PACKET_SIZE)
-
-        obj = connect_resp.parse(msg)
+        obj = connect_resp.parse(responses[tx])
         log.debug('connection: {}'.format(obj.connection_id))
-
-        if obj.action != 0:
+        if obj.action != CONNECT:
             raise Error('Incorrect action: {}'.format(obj))
 
-        if obj.transaction_id != tx:
-            raise Error('Unexpected transaction_id: {}'.format(obj))
-
         self.id = obj.connection_id
+        self.id_time = time.time()
 
     def announce(self, peer, data, **kw):
         
-        if self.conn is None:
-            raise Error('Must connect to tracker before announcement')
+        self.connect()
 
         tx = random.getrandbits(32)
         kw = {
             'transaction_id': tx, 
-            'action': 1, 
+            'action': ANNOUNCE, 
             'connection_id': self.id, 
             'event': kw.get('event', 0),
             'ip_addr': 0,
@@ -137,66 +170,366 @@ class udp:
         obj = c.Container(**kw)
 
         log.debug('request peers for {}'.format(binascii.hexlify(obj.info_hash)))
-        msg = announce_req.build(obj)
-        self.conn.send(msg)
+        responses = self._exchange({tx: announce_req.build(obj)})
+        obj = announce_resp.parse(responses[tx])
 
-        # handle response
-        msg = self.conn.recv(MAX_PACKET_SIZE)        
-        obj = announce_resp.parse(msg)
-
-        if obj.action != 1:
+        if obj.action != ANNOUNCE:
             raise Error('Incorrect action: {}'.format(obj))
 
-        if obj.transaction_id != tx:
-            raise Error('Unexpected transaction_id: {}'.format(obj))
-
         peer_list = [('{}.{}.{}.{}'.format(*p.addr), p.port) for p in obj.peer]
-        log.info('got {} peers from {}'.format(len(peer_list), self.conn.getpeername()))
+        log.info('got {} peers from {}'.format(len(peer_list), self.addr))
         
         fields = ('interval', 'seeders', 'leechers')
         log.info('statistics: {}'.format({k: obj[k] for k in fields}))
+        self.interval, self.seeders, self.leechers = [obj[k] for k in fields]
         return peer_list
 
+    def scrape(self, info_hashes):
+        ''' Return {info_hash: Stats} for all `info_hashes`, packing them into
+            as few packets as possible, and sending several packets at once.
+        '''
+        info_hashes = list(info_hashes)
+        chunks = [info_hashes[i:i+MAX_SCRAPE_HASHES]
+                  for i in xrange(0, len(info_hashes), MAX_SCRAPE_HASHES)]
+        result = {}
+        for i in xrange(0, len(chunks), MAX_SCRAPE_PACKETS):
+            self.connect()
+            requests = {}
+            for chunk in chunks[i:i+MAX_SCRAPE_PACKETS]:
+                tx = random.getrandbits(32)
+                obj = c.Container(connection_id=self.id, action=SCRAPE, transaction_id=tx,
+                                  hashes=[c.Container(info_hash=h) for h in chunk])
+                requests[tx] = (chunk, scrape_req.build(obj))
+
+            responses = self._exchange({tx: msg for tx, (_, msg) in requests.items()})
+            for tx, (chunk, _) in requests.items():
+                obj = scrape_resp.parse(responses[tx])
+                if obj.action != SCRAPE or len(obj.stats) != len(chunk):
+                    raise Error('Incorrect scrape response: {}'.format(obj))
+                for h, st in zip(chunk, obj.stats):
+                    result[h] = Stats(st.seeders, st.completed, st.leechers)
+
+        log.info('scraped {} torrents from {}'.format(len(result), self.addr))
+        return result
+
+    def _exchange(self, requests):
+        ''' Send requests ({transaction_id: packet}) and return their
+            responses, retransmitting the unanswered ones on timeout.
+        '''
+        results = {}
+        for tx in requests:
+            results[tx] = self.waiting[tx] = gevent.event.AsyncResult()
+        if self.reader is None or self.reader.dead:
+            self.reader = gevent.spawn(self._read)
+        try:
+            for n in xrange(self.retries + 1):
+                for tx, msg in requests.items():
+                    if not results[tx].ready():
+                        self.conn.send(msg)
+
+                deadline = time.time() + self.timeout * 2**n
+                pending = [r for r in results.values() if not r.ready()]
+                while pending:
+                    ready = gevent.wait(pending, timeout=max(deadline - time.time(), 0), count=1)
+                    if not ready:
+                        break
+                    for r in ready:
+                        r.get() # raise the error from the tracker
+                    pending = [r for r in pending if not r.ready()]
+                else:
+                    return {tx: r.get() for tx, r in results.items()}
+
+                log.debug('no response from {} after {}s'.format(self.addr, self.timeout * 2**n))
+        finally:
+            for tx in requests:
+                self.waiting.pop(tx, None)
+
+        raise Error('{} is not responding'.format(self.addr))
+
+    def _read(self):
+        ''' Pass each response to the exchange waiting for it. '''
+        try:
+            while True:
+                msg = self.conn.recv(MAX_PACKET_SIZE)
+                if len(msg) < _header.size:
+                    log.warning('short packet from {}'.format(self.addr))
+                    continue
+                action, tx = _header.unpack_from(msg)
+                result = self.waiting.pop(tx, None)
+                if result is None:
+                    continue # a late response to an earlier exchange
+                if action == ERROR:
+                    self.id = None # it may have expired at the tracker
+                    result.set_exception(Error('{} failed: {}'.format(self.addr, msg[_header.size:])))
+                else:
+                    result.set(msg)
+        except socket.error, e: # e.g. an ICMP "port unreachable"
+            for result in self.waiting.values():
+                result.set_exception(e)
+
+class Client:
+    ''' Announces to several UDP trackers concurrently, keeping a
+        connection (and its ID) per tracker address.
+    '''
+    def __init__(self, timeout=RETRANSMIT_TIMEOUT, retries=MAX_RETRANSMITS):
+        self.timeout = timeout
+        self.retries = retries
+        self.trackers = {} # address -> udp
+
+    def tracker(self, url):
+        addr = parse_address(url)
+        t = self.trackers.get(addr)
+        if t is None:
+            t = self.trackers[addr] = udp(addr, timeout=self.timeout, retries=self.retries)
+        return t
+
+    def interval(self, urls):
+        ''' Return the shortest announce interval of the trackers (None if unknown). '''
+        intervals = []
+        for url in urls:
+            try:
+                t = self.trackers.get(parse_address(url))
+            except Error:
+                continue # never announced to
+            if t is not None and t.interval is not None:
+                intervals.append(t.interval)
+        return min(intervals) if intervals else None
+
+    def announce(self, urls, info_hash, peer_id, port=6889, num_want=-1,
+                 uploaded=0, downloaded=0, left=0, event=0):
+        ''' Announce to all the trackers in `urls` concurrently, and yield
+            each new peer address as soon as some tracker returns it.
+        '''
+        peer = dict(peer_id=peer_id, port=port)
+        data = dict(info_hash=info_hash, uploaded=uploaded, downloaded=downloaded, left=left)
+        results = gevent.queue.Queue()
+
+        def announce(url):
+            peers = []
+            try:
+                peers = self.tracker(url).announce(peer, data, num_want=num_want, event=event)
+            except (Error, socket.error, c.ConstructError), e:
+                log.warning('announce to {} failed: {}'.format(url, e))
+            finally:
+                results.put(peers)
+
+        urls = list(OrderedDict.fromkeys(urls))
+        for url in urls:
+            gevent.spawn(announce, url)
+
+        seen = set()
+        for _ in urls:
+            for addr in results.get():
+                if addr not in seen:
+                    seen.add(addr)
+                    yield addr
+
+    def scrape(self, url, info_hashes):
+        ''' Return {info_hash: Stats} from the tracker at `url`. '''
+        return self.tracker(url).scrape(info_hashes)
+
 def parse_address(url):
-    ''' Parse tracker address of the form "udp://address:port/".
+    ''' Parse tracker address of the form "udp://host:port[/announce]".
     '''
-    url = url.rstrip('/')
-    proto, url = url.split('://')
-    assert proto == 'udp'
-
-    addr, port = url.split(':')
-    port = int(port)
-
-    return (addr, port)
-
-def get_peers(addr, info_hash, peer_id, timeout=None, port=6889, num_want=-1, 
-                uploaded=0, downloaded=0, left=0):
-
-    peer = dict(peer_id=peer_id, port=port)
-    data = dict(info_hash=info_hash, uploaded=uploaded, downloaded=downloaded, left=left)
-
-    addr = parse_address(addr)
-    while True:
-        try:            
-            log.debug('connecting to {}'.format(addr))
-            tracker = udp(addr, timeout=timeout)
-            tracker.connect()
-            return tracker.announce(peer, data, num_want=num_want)
-        except socket.timeout:
-            log.warning('timeout')
-        except socket.error, e:
-            log.warning('unreachable: {}'.format(addr))
-
-def test_tracker(arg):
+    u = urlparse.urlsplit(url)
+    if u.scheme != 'udp':
+        raise Error('unsupported tracker: {}'.format(url))
+    try:
+        port = u.port
+    except ValueError: # not a number
+        port = None
+    if not u.hostname or not port:
+        raise Error('invalid tracker address: {}'.format(url))
+
+    return (u.hostname, port)
+
+client = Client()
+
+def get_peers(urls, info_hash, peer_id, **kw):
+    ''' Return the merged peer list from all the trackers in `urls`. '''
+    if isinstance(urls, str):
+        urls = [urls]
+    return list(client.announce(urls, info_hash, peer_id, **kw))
+
+def scrape(url, info_hashes):
+    ''' Return {info_hash: Stats} for many torrents tracked at `url`. '''
+    return client.scrape(url, info_hashes)
+
+class Server:
+    ''' A minimal UDP tracker, standing in for real ones in tests.
+
+    Announcing peers are added to the swarm of their info hash. The first
+    `drop` requests are ignored (to exercise retransmission), and responses
+    are sent after `delay` seconds.
+    '''
+    def __init__(self, addr=('127.0.0.1', 0), interval=1800, delay=0, drop=0):
+        self.swarms = {} # info_hash -> [(host, port)]
+        self.interval = interval
+        self.delay = delay
+        self.drop = drop
+        self.ids = set()
+        self.requests = collections.Counter() # action -> count
+        self.server = gevent.server.DatagramServer(addr, self._handle)
+
+    def start(self):
+        self.server.start()
+        self.addr = self.server.address
+        self.url = 'udp://{}:{}'.format(*self.addr)
+
+    def stop(self):
+        self.server.stop()
+
+    def _handle(self, msg, addr):
+        if self.drop > 0:
+            self.drop = self.drop - 1
+            return
+        gevent.sleep(self.delay)
+
+        connection_id, action, tx = _request_header.unpack_from(msg)
+        self.requests[action] += 1
+        if action == CONNECT:
+            obj = c.Container(action=CONNECT, transaction_id=tx,
+                              connection_id=random.getrandbits(64))
+            self.ids.add(obj.connection_id)
+            self.server.sendto(connect_resp.build(obj), addr)
+            return
+
+        if connection_id not in self.ids:
+            reply = _header.pack(ERROR, tx) + 'invalid connection ID'
+            self.server.sendto(reply, addr)
+            return
+
+        if action == ANNOUNCE:
+            req = announce_req.parse(msg)
+            swarm = self.swarms.setdefault(req.info_hash, [])
+            peers = [p for p in swarm if p != (addr[0], req.port)]
+            if req.num_want >= 0:
+                peers = peers[:req.num_want]
+            if (addr[0], req.port) not in swarm:
+                swarm.append((addr[0], req.port))
+            obj = c.Container(action=ANNOUNCE, transaction_id=tx, interval=self.interval,
+                              leechers=len(swarm), seeders=0,
+                              peer=[c.Container(addr=map(int, host.split('.')), port=port)
+                                    for host, port in peers])
+            self.server.sendto(announce_resp.build(obj), addr)
+
+        if action == SCRAPE:
+            req = scrape_req.parse(msg)
+            stats = [c.Container(seeders=0, completed=0,
+                                 leechers=len(self.swarms.get(h.info_hash, [])))
+                     for h in req.hashes]
+            obj = c.Container(action=SCRAPE, transaction_id=tx, stats=stats)
+            self.server.sendto(scrape_resp.build(obj), addr)
+
+def test_tracker(link):
     logging.basicConfig(
         format='%(asctime)-15s [%(levelname)s] %(message)s', 
         level=logging.DEBUG)
     
-    meta = metainfo.MetaInfo(arg)
-    peers = get_peers(meta, peer_id=metainfo.hash('test_tracker'), port=6889, timeout=10)
+    m = metainfo.parse_magnet(link)
+    peers = get_peers(m['trackers'], m['info_hash'], peer_id=metainfo.hash('test_tracker'), port=6889)
     print peers
 
+## Unittests
+
+def test():
+    assert parse_address('udp://tracker.example.com:1337/announce') == ('tracker.example.com', 1337)
+    assert parse_address('udp://10.0.0.1:80') == ('10.0.0.1', 80)
+    for url in ['http://example.com/announce', 'udp://example.com', 'udp://example.com:x/',
+                'udp://:80', 'udp:/example.com:80']:
+        try:
+            parse_address(url)
+        except Error:
+            pass
+        else:
+            assert False, url
+
+    info_hash = metainfo.hash('info')
+    peer_id = metainfo.hash('peer')
+    swarm = [('10.0.0.{}'.format(i), 6881) for i in range(1, 5)]
+
+    fast, slow = Server(), Server(delay=2)
+    for s in (fast, slow):
+        s.swarms[info_hash] = list(swarm)
+        s.start()
+
+    # peers arrive from the fastest tracker first, and are not duplicated
+    cl = Client(timeout=5)
+    start = time.time()
+    peers = cl.announce([slow.url, 'http://example.com/announce', fast.url + '/announce',
+                         'udp://example.com:x/announce'], info_hash, peer_id)
+    first = next(peers)
+    assert time.time() - start < 1
+    assert sorted([first] + list(peers)) == swarm
+    assert fast.requests[ANNOUNCE] == slow.requests[ANNOUNCE] == 1
+
+    # the connection ID is reused while valid
+    assert get_peers(fast.url, info_hash, peer_id) == get_peers(fast.url, info_hash, peer_id)
+    assert fast.requests[CONNECT] == 2 # by `cl` and by `client`
+    t = client.tracker(fast.url)
+    t.id_time -= CONNECTION_ID_TTL
+    get_peers(fast.url, info_hash, peer_id)
+    assert fast.requests[CONNECT] == 3
+
+    # unknown connection IDs are rejected, and a new one is requested next time
+    t.id = 0
+    try:
+        t.announce(dict(peer_id=peer_id, port=1), dict(info_hash=info_hash, uploaded=0, downloaded=0, left=0))
+        assert False
+    except Error:
+        assert t.id is None
+    assert len(get_peers(fast.url, info_hash, peer_id)) == len(swarm)
+
+    # lost requests are retransmitted
+    lossy = Server(drop=2)
+    lossy.start()
+    cl = Client(timeout=0.1, retries=2)
+    start = time.time()
+    assert list(cl.announce([lossy.url], info_hash, peer_id)) == []
+    assert time.time() - start >= 0.1 + 0.2
+    assert lossy.requests[CONNECT] == 1
+
+    lossy.drop = 3
+    try:
+        cl.tracker(lossy.url).announce(dict(peer_id=peer_id, port=1),
+            dict(info_hash=info_hash, uploaded=0, downloaded=0, left=0))
+        assert False
+    except Error:
+        pass
+
+    # a lost request holds back no other exchange with the tracker
+    lossy.drop = 0
+    cl = Client(timeout=0.5, retries=1)
+    t = cl.tracker(lossy.url)
+    t.connect()
+    lossy.drop = 1
+    args = (dict(peer_id=peer_id, port=1), dict(info_hash=info_hash, uploaded=0, downloaded=0, left=0))
+    start = time.time()
+    lost = gevent.spawn(t.announce, *args)
+    gevent.sleep(0.01)
+    t.announce(*args)
+    assert time.time() - start < 0.5 and not lost.ready()
+    lost.get()
+    assert time.time() - start >= 0.5
+
+    # scraping many torrents, over the cached connection
+    hashes = [metainfo.hash(str(i)) for i in range(200)]
+    for i, h in enumerate(hashes):
+        fast.swarms[h] = swarm[:i % len(swarm)]
+    connects = fast.requests[CONNECT]
+    stats = scrape(fast.url, hashes)
+    assert fast.requests[SCRAPE] == 3 and fast.requests[CONNECT] == connects
+    assert [stats[h].leechers for h in hashes] == [i % len(swarm) for i in range(200)]
+    assert scrape(fast.url, []) == {}
+
+    for s in (fast, slow, lossy):
+        s.stop()
+
 if __name__ == '__main__':
     import sys
-    arg, = sys.argv[1:]
-    test_tracker(arg)
+    args = sys.argv[1:]
+    if args:
+        test_tracker(*args)
+    else:
+        logging.basicConfig(level=logging.ERROR)
+        test()